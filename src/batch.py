@@ -0,0 +1,238 @@
+import os
+import sys
+import fnmatch
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import chain
+from typing import Deque, Dict, List, Set, Tuple
+
+import instrument
+from generate_group_configs import generate_groups_configs
+from mergecache import get_merge_cache
+from meshpool import MeshPool
+from mod import get_mod_index
+from clusterlod import ClusterLods
+from spatial import ClusterLimits
+from staticobject import Staticobject
+from templatecache import get_template_cache
+
+from merge import (
+    MergeJob, finish_merged, generate_merged, get_cluster_executor,
+    place_cluster_object, prepare_merged, set_logging, submit_cluster)
+
+def match_names(names: List[str], patterns: List[str], exclude: List[str] = ()) -> List[str]:
+    # case insensitive like the game filesystem
+    def matches(name: str, patterns: List[str]):
+        return any(fnmatch.fnmatchcase(name.lower(), pattern.lower()) for pattern in patterns)
+    return sorted(name for name in names if matches(name, patterns) and not matches(name, exclude))
+
+def find_levels(modroot: os.PathLike, patterns: List[str]) -> List[str]:
+    levelsroot = os.path.join(modroot, 'levels')
+    names = [entry.name for entry in os.scandir(levelsroot) if entry.is_dir()]
+    return match_names(names, patterns)
+
+def find_configs(levelroot: os.PathLike, patterns: List[str], exclude: List[str]) -> List[str]:
+    names = [entry.name for entry in os.scandir(levelroot) if entry.is_file()]
+    return match_names(names, patterns, exclude)
+
+class QueuedJob(object):
+    # prepared config waiting for its cluster futures, shared ones come from another config of the level
+
+    def __init__(self, job: MergeJob, futures: List[Future], owners: List[List[Staticobject]]):
+        self.job = job
+        self.futures = futures
+        # cluster whose generation each future is, placed as shared template when not this job's own
+        self.owners = owners
+
+    def done(self) -> bool:
+        return all(future.done() for future in self.futures)
+
+def submit_clusters(
+        executor: ProcessPoolExecutor,
+        job: MergeJob,
+        submitted: Dict[Tuple[str, str], Tuple[Future, List[Staticobject]]],
+        lods: ClusterLods = None,
+        ) -> QueuedJob:
+    # equal names are equal geometry, configs of a level never generate same folder twice or at once
+    futures: List[Future] = []
+    owners: List[List[Staticobject]] = []
+    for cluster, name_cluster in zip(job.visible.unique, job.visible.names):
+        key = (job.levelroot, name_cluster)
+        if key not in submitted:
+            submitted[key] = (submit_cluster(executor, cluster, job.levelroot, lods, name_cluster), cluster)
+        future, owner = submitted[key]
+        futures.append(future)
+        owners.append(owner)
+    return QueuedJob(job, futures, owners)
+
+def collect_clusters(queued: QueuedJob, collected: Set[Future]) -> List[Staticobject]:
+    generated: List[Staticobject] = []
+    for cluster, future, owner in zip(queued.job.visible.unique, queued.futures, queued.owners):
+        staticobject, counters = future.result()
+        # counters of shared future are counted once
+        if future not in collected:
+            collected.add(future)
+            instrument.instrumentation.merge_counters(counters)
+        if owner is not cluster:
+            staticobject = place_cluster_object(cluster, staticobject, owner[0])
+        generated.append(staticobject)
+    return generated
+
+def compile_levels(
+        modroot: os.PathLike,
+        levels: List[str],
+        config_patterns: List[str],
+        config_exclude: List[str],
+        split_source: str = None,
+        jobs: int = 1,
+        rebuild: bool = False,
+        limits: ClusterLimits = None,
+        dedup: bool = True,
+        cache: bool = True,
+        meshpool_capacity: int = 512 * 1024 * 1024,
+        lods: ClusterLods = None,
+        ) -> List[str]:
+    # mod index, caches, mesh pool and worker pool are built once for every level
+    # returns '<level>/<config>' of failed compiles
+    with instrument.stage('index'):
+        modindex = get_mod_index(modroot, cache=cache, jobs=jobs)
+    mergecache = get_merge_cache(modroot, cache=cache)
+    meshpool = MeshPool(meshpool_capacity)
+    templatecache = get_template_cache(modroot, cache=cache, mergecache=mergecache)
+    executor = get_cluster_executor(modindex.templates, meshpool, jobs) if jobs > 1 else None
+
+    failed: List[str] = []
+    # with workers, clusters of every config are queued as soon as it is prepared and configs are
+    # finished in order once their clusters are done, parent splits, parses and writes meanwhile
+    queue: Deque[QueuedJob] = deque()
+    submitted: Dict[Tuple[str, str], Tuple[Future, List[Staticobject]]] = {}
+    collected: Set[Future] = set()
+
+    def finish(queued: QueuedJob):
+        job = queued.job
+        # objects of configs still queued in same level are not stale
+        keep = set(chain.from_iterable(
+            other.job.visible.used_names for other in queue if other.job.levelroot == job.levelroot))
+        try:
+            with instrument.stage('level', level=job.levelname, config=job.config_fname):
+                with instrument.stage('visible', jobs=jobs):
+                    generated = collect_clusters(queued, collected)
+                finish_merged(job, generated, modindex.templates, templatecache, keep)
+            instrument.count('configs_merged')
+        except Exception as err:
+            logging.critical('Failed to generate merge from %s/%s', job.levelname, job.config_fname, exc_info=err)
+            failed.append(f'{job.levelname}/{job.config_fname}')
+        # keep results of finished configs if a later one crashes the run
+        mergecache.save()
+
+    try:
+        for levelname in levels:
+            levelroot = os.path.join(modroot, 'levels', levelname)
+            if split_source:
+                source = os.path.join(levelroot, split_source)
+                if not os.path.isfile(source):
+                    logging.warning('%s has no %s, using existing group configs', levelname, split_source)
+                else:
+                    with instrument.stage('split', level=levelname):
+                        generate_groups_configs(source)
+            configs = find_configs(levelroot, config_patterns, config_exclude)
+            if not configs:
+                logging.warning('no group configs to merge in %s', levelroot)
+            for config_fname in configs:
+                logging.info('Merging meshes from %s/%s', levelname, config_fname)
+                if executor is None:
+                    try:
+                        with instrument.stage('level', level=levelname, config=config_fname):
+                            generate_merged(
+                                modroot, levelname, config_fname,
+                                modindex, mergecache, meshpool,
+                                jobs, rebuild, limits, dedup=dedup,
+                                templatecache=templatecache, lods=lods)
+                        instrument.count('configs_merged')
+                    except Exception as err:
+                        logging.critical('Failed to generate merge from %s/%s', levelname, config_fname, exc_info=err)
+                        failed.append(f'{levelname}/{config_fname}')
+                    continue
+                try:
+                    with instrument.stage('prepare', level=levelname, config=config_fname):
+                        job = prepare_merged(
+                            modroot, levelname, config_fname,
+                            modindex, mergecache, meshpool,
+                            rebuild, limits, dedup=dedup, lods=lods)
+                except Exception as err:
+                    logging.critical('Failed to generate merge from %s/%s', levelname, config_fname, exc_info=err)
+                    failed.append(f'{levelname}/{config_fname}')
+                    continue
+                queue.append(submit_clusters(executor, job, submitted, lods))
+                while queue and queue[0].done():
+                    finish(queue.popleft())
+            mergecache.save()
+        while queue:
+            finish(queue.popleft())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        mergecache.save()
+    return failed
+
+def main(args):
+    modroot = os.path.join(args.root, args.modPath)
+    levels = find_levels(modroot, args.levels)
+    logging.info('Compiling %s levels in %s', len(levels), modroot)
+    if args.profile:
+        instrument.instrumentation.start_profile()
+    if args.tracemalloc:
+        instrument.instrumentation.start_tracemalloc()
+    try:
+        limits = ClusterLimits(args.max_cluster_radius, args.max_cluster_vertices, args.max_cluster_indices)
+        lods = ClusterLods(args.cluster_lod_drop_ratio, args.cluster_extra_lods)
+        failed = compile_levels(
+            modroot, levels, args.configs, args.exclude, args.split,
+            args.jobs, args.rebuild, limits, not args.no_dedup, not args.no_cache,
+            args.mesh_pool_size * 1024 * 1024, lods)
+    finally:
+        if args.profile:
+            instrument.instrumentation.stop_profile(args.profile)
+        if args.tracemalloc:
+            instrument.instrumentation.stop_tracemalloc()
+        if args.report:
+            instrument.instrumentation.write_report(args.report)
+    for name in failed:
+        print(f'failed: {name}')
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename=f'{os.path.basename(__file__)}.log',
+        filemode='w',
+        format='[%(asctime)s] %(levelname)s:%(name)s:%(funcName)s:%(message)s',
+        datefmt='%X',
+        level=logging.ERROR,
+    )
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', help='Set verbosity level', action='count')
+    parser.add_argument('--root', help="Path to game directory", default=os.path.join('E:/', 'Games', 'Project Reality'))
+    parser.add_argument('--modPath', help="Path to mod relative to game root", default=os.path.join('mods', 'pr_repo'))
+    parser.add_argument('--levels', help="Level names or globs", nargs='+', default=['*'])
+    parser.add_argument('--configs', help="Group config names or globs in each level", nargs='+', default=['staticobjects_*.con'])
+    parser.add_argument('--exclude', help="Config names or globs never merged", nargs='+', default=['*_merged.con', 'staticobjects_0.con'])
+    parser.add_argument('--split', help="Split this config by groups in every level first, e.g. StaticObjects.con")
+    parser.add_argument('--no-cache', help="Ignore cached mod index, merge tests and collision templates", action='store_true')
+    parser.add_argument('-j', '--jobs', help="Number of worker processes shared by all levels", type=int, default=1)
+    parser.add_argument('--rebuild', help="Regenerate every cluster even if unchanged", action='store_true')
+    parser.add_argument('--max-cluster-radius', help="Split clusters wider than this radius in meters", type=float)
+    parser.add_argument('--max-cluster-vertices', help="Split clusters with more vertices", type=int)
+    parser.add_argument('--max-cluster-indices', help="Split clusters with more indices", type=int)
+    parser.add_argument('--no-dedup', help="Export every cluster even if another one has same geometry", action='store_true')
+    parser.add_argument('--cluster-lod-drop-ratio', help="Leave members smaller than this share of cluster radius out of lod 1, doubling every lower lod", type=float, default=0.0)
+    parser.add_argument('--cluster-extra-lods', help="Add this many lods after the last source lod from coarsest member lods", type=int, default=0)
+    parser.add_argument('--report', help="Write stage timings and counters as json/trace events to this path")
+    parser.add_argument('--profile', help="Write cProfile stats of whole run to this path")
+    parser.add_argument('--tracemalloc', help="Add peak memory and top allocations to report", action='store_true')
+    parser.add_argument('--mesh-pool-size', help="Memory cap in MB for pooled source meshes, split between worker processes with -j", type=int, default=512)
+    args = parser.parse_args()
+    set_logging(args)
+
+    sys.exit(main(args))
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+from itertools import chain
+from typing import Callable, List
+
+import numpy as np
+
+from bf2config import ObjectBlock
+from geometry import Geometry
+from mergecache import MergeCache
+from meshpool import MeshPool
+from mod import get_mod_index
+from objectTemplate import load_geometries
+from staticmesh import Lod, Material, StaticMesh
+from staticobject import StaticobjectTable, parse_config_table
+
+from merge import (
+    generate_collisions, generate_config, generate_visible,
+    get_clusters, get_groups, get_merge_clusters, get_single_objects)
+
+BENCHMARK_VERSION = 1
+
+
+class SyntheticSignatures(object):
+    # stands in for MergeCache, signature is precomputed per geometry
+
+    def __init__(self, signatures: int):
+        self.signatures = signatures
+
+    def get_signature(self, geometry: Geometry) -> int:
+        return int(geometry.name[4:]) % self.signatures
+
+def generate_table(objects: int, groups: int, templates: int, seed: int = 0) -> StaticobjectTable:
+    rng = random.Random(seed)
+    blocks: List[ObjectBlock] = []
+    for _ in range(objects):
+        block = ObjectBlock(f'mesh{rng.randrange(templates)}')
+        block.position = (rng.uniform(-2048, 2048), rng.uniform(0, 100), rng.uniform(-2048, 2048))
+        block.rotation = (rng.choice([0.0, 90.0, 180.0, 270.0]), 0.0, 0.0)
+        # few objects stay ungrouped like on real levels
+        block.group = rng.randrange(groups) if rng.random() > 0.1 else 0
+        blocks.append(block)
+    table = StaticobjectTable.from_blocks(blocks)
+    for name_id, name in enumerate(table.names):
+        table.name_geometries[name_id] = Geometry(name, f'{name}.staticmesh')
+    return table
+
+def timeit(function: Callable, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def legacy_single_objects(staticobjects, clusters):
+    return [staticobject for staticobject in staticobjects if staticobject not in chain(*clusters)]
+
+def generate_staticmesh(path: os.PathLike, lods: int, vertices: int, texture: str, seed: int = 0):
+    # smallest valid layout: position, normal, uv, tangent and one material per lod
+    rng = np.random.default_rng(seed)
+    mesh = StaticMesh()
+    mesh.vertattribs = [(0, 0, 2, 0), (0, 12, 2, 3), (0, 24, 1, 5), (0, 32, 2, 6), (255, 0, 17, 0)]
+    mesh.vertstride = 44
+    mesh.geoms = [[Lod() for _ in range(lods)]]
+    vertex_chunks, index_chunks = [], []
+    for lodId, lod in enumerate(mesh.geoms[0]):
+        material = Material()
+        material.fxfile = 'StaticMesh.fx'
+        material.technique = 'Base'
+        material.maps = [texture]
+        material.vstart, material.istart = lodId * vertices, lodId * vertices * 3
+        material.vnum, material.inum = vertices, vertices * 3
+        lod.materials = [material]
+        lod.nodes = np.eye(4, dtype='<f4').reshape(1, 16)
+        vertex_chunks.append(rng.uniform(-1, 1, (vertices, 11)).astype('<f4'))
+        index_chunks.append((np.arange(vertices * 3) % vertices).astype('<u2'))
+    mesh.vertices = np.concatenate(vertex_chunks)
+    mesh.index = np.concatenate(index_chunks)
+    mesh.update_bounds()
+    mesh.export(path)
+
+def generate_mod(
+        modroot: os.PathLike,
+        levelname: str,
+        config_fname: str,
+        objects: int,
+        groups: int,
+        templates: int,
+        signatures: int,
+        seed: int = 0,
+        ):
+    # templates in objects/, grouped staticobjects config in levels/<levelname>/
+    rng = random.Random(seed)
+    for template in range(templates):
+        name = f'mesh{template}'
+        path_object = os.path.join(modroot, 'objects', 'staticobjects', 'benchmark', name)
+        # lod count is what tells merge signatures apart
+        generate_staticmesh(
+            os.path.join(path_object, 'meshes', f'{name}.staticmesh'),
+            lods=1 + template % signatures, vertices=24, texture=f'texture{template % 4}.dds', seed=template)
+        with open(os.path.join(path_object, f'{name}.con'), 'w') as config:
+            config.write(
+                f'ObjectTemplate.create SimpleObject {name}\n'
+                f'ObjectTemplate.geometry {name}\n'
+                f'ObjectTemplate.collisionMesh {name}\n'
+                f'ObjectTemplate.mapMaterial 0 default 0\n'
+                f'ObjectTemplate.hasCollisionPhysics 1\n'
+                f'GeometryTemplate.create StaticMesh {name}\n'
+                f'GeometryTemplate.scale 1/1/1\n')
+        with open(os.path.join(path_object, f'{name}.tweak'), 'w') as tweak:
+            tweak.write(f'ObjectTemplate.activeSafe SimpleObject {name}\nObjectTemplate.cullRadiusScale 2\n')
+        os.makedirs(os.path.join(path_object, 'textures'), exist_ok=True)
+        with open(os.path.join(path_object, 'textures', f'{name}_c.dds'), 'wb') as texture:
+            texture.write(bytes(4096))
+
+    levelroot = os.path.join(modroot, 'levels', levelname)
+    os.makedirs(levelroot, exist_ok=True)
+    with open(os.path.join(levelroot, config_fname), 'w') as config:
+        for staticobject in generate_table(objects, groups, templates, seed):
+            config.write(
+                f'Object.create {staticobject.name}\n'
+                f'Object.absolutePosition {"/".join(f"{axis:.3f}" for axis in staticobject.position)}\n'
+                f'Object.rotation {"/".join(f"{axis:.3f}" for axis in staticobject.rotation)}\n'
+                f'Object.layer 1\n'
+                f'Object.group {staticobject.group}\n\n')
+
+def bench_pipeline(
+        sizes: List[int],
+        groups: int,
+        templates: int,
+        signatures: int,
+        workdir: os.PathLike,
+        jobs: int = 1,
+        ) -> List[dict]:
+    results: List[dict] = []
+    stages = ['index', 'parse', 'geometries', 'clusters', 'singles', 'visible', 'collisions', 'config']
+    print(f'{"objects":>10} {"clusters":>10} ' + ' '.join(f'{stage:>11}' for stage in stages))
+    for size in sizes:
+        modroot = os.path.join(workdir, f'mod{size}')
+        shutil.rmtree(modroot, ignore_errors=True)
+        generate_mod(modroot, 'benchmark', 'staticobjects.con', size, groups, templates, signatures)
+        levelroot = os.path.join(modroot, 'levels', 'benchmark')
+
+        times = {}
+        modindex, times['index'] = timeit(get_mod_index, modroot, True, False)
+        table, times['parse'] = timeit(parse_config_table, os.path.join(levelroot, 'staticobjects.con'))
+        _, times['geometries'] = timeit(load_geometries, table, modindex)
+        meshpool = MeshPool()
+        clusters, times['clusters'] = timeit(get_merge_clusters, table, MergeCache(), meshpool)
+        singles, times['singles'] = timeit(get_single_objects, table.staticobjects, clusters)
+        visible, times['visible'] = timeit(
+            generate_visible, clusters, modindex.templates, levelroot, meshpool, jobs)
+        _, times['collisions'] = timeit(generate_collisions, clusters, modindex.templates, levelroot)
+        _, times['config'] = timeit(generate_config, visible, clusters, singles, levelroot, 'staticobjects.con')
+
+        print(f'{size:>10} {len(clusters):>10} ' + ' '.join(f'{times[stage]:>10.3f}s' for stage in stages))
+        for stage in stages:
+            results.append({
+                'suite': 'pipeline', 'stage': stage, 'objects': size,
+                'groups': groups, 'templates': templates, 'clusters': len(clusters),
+                'seconds': times[stage]})
+    return results
+
+def bench_clusters(sizes: List[int], groups: int, templates: int, signatures: int, legacy_limit: int) -> List[dict]:
+    results: List[dict] = []
+    print(f'{"objects":>10} {"groups":>10} {"clusters":>10} {"clustering":>12} {"singles":>12} {"legacy":>12}')
+    for size in sizes:
+        table = generate_table(size, groups, templates)
+        mergecache = SyntheticSignatures(signatures)
+        grouped, time_groups = timeit(get_groups, table)
+        clusters, time_clusters = timeit(get_clusters, grouped, mergecache)
+        singles, time_singles = timeit(get_single_objects, table.staticobjects, clusters)
+        legacy = '-'
+        if size <= legacy_limit:
+            legacy_singles, time_legacy = timeit(legacy_single_objects, table.staticobjects, clusters)
+            assert legacy_singles == singles
+            legacy = f'{time_legacy:.3f}s'
+        print(f'{size:>10} {len(grouped):>10} {len(clusters):>10} '
+              f'{time_groups + time_clusters:>11.3f}s {time_singles:>11.3f}s {legacy:>12}')
+        for stage, seconds in [('clustering', time_groups + time_clusters), ('singles', time_singles)]:
+            results.append({
+                'suite': 'clusters', 'stage': stage, 'objects': size,
+                'groups': groups, 'templates': templates, 'clusters': len(clusters),
+                'seconds': seconds})
+    return results
+
+def write_results(path: os.PathLike, results: List[dict]):
+    with open(path, 'w') as resultsfile:
+        json.dump({
+            'version': BENCHMARK_VERSION,
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'results': results,
+            }, resultsfile, indent=1)
+
+def main(args):
+    results: List[dict] = []
+    if args.suite in ['clusters', 'all']:
+        results += bench_clusters(args.sizes, args.groups, args.templates, args.signatures, args.legacy_limit)
+    if args.suite in ['pipeline', 'all']:
+        if args.workdir:
+            results += bench_pipeline(
+                args.pipeline_sizes, args.groups, args.templates, args.signatures, args.workdir, args.jobs)
+        else:
+            with tempfile.TemporaryDirectory(prefix='levelcompiler-benchmark-') as workdir:
+                results += bench_pipeline(
+                    args.pipeline_sizes, args.groups, args.templates, args.signatures, workdir, args.jobs)
+    if args.output:
+        write_results(args.output, results)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', help='Object counts to benchmark', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--groups', help='Editor groups in synthetic level', type=int, default=500)
+    parser.add_argument('--templates', help='Distinct templates in synthetic level', type=int, default=200)
+    parser.add_argument('--signatures', help='Distinct merge signatures', type=int, default=8)
+    parser.add_argument('--legacy-limit', help='Largest size to also time legacy chain() filtering', type=int, default=10000)
+    parser.add_argument('--suite', help='Benchmarks to run', choices=['clusters', 'pipeline', 'all'], default='all')
+    parser.add_argument('--pipeline-sizes', help='Object counts for end-to-end runs on synthetic mod', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--workdir', help='Keep synthetic mods here instead of temporary directory')
+    parser.add_argument('-j', '--jobs', help='Worker processes for cluster generation', type=int, default=1)
+    parser.add_argument('--output', help='Write results as json to this path')
+    args = parser.parse_args()
+
+    main(args)
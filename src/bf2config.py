@@ -0,0 +1,62 @@
+import os
+import logging
+from typing import Dict, Iterator, List, Tuple
+
+Float3 = Tuple[float, float, float]
+
+class ObjectBlock(object):
+
+    def __init__(self, name: str):
+        self.name = name
+        self.position: Float3 = (0.0, 0.0, 0.0)
+        self.rotation: Float3 = (0.0, 0.0, 0.0)
+        self.layer = 1
+        self.group = 0
+        # other Object.* commands, in file order
+        self.properties: Dict[str, str] = {}
+        # Object.* lines as read, create included
+        self.lines: List[str] = []
+
+    def __repr__(self):
+        return f'{self.name}'
+
+def parse_float3(value: str) -> Float3:
+    x, y, z = value.split('/')
+    return (float(x), float(y), float(z))
+
+def iter_object_blocks(fname: os.PathLike) -> Iterator[ObjectBlock]:
+    # one pass over lines, block is every Object.* command up to next Object.create
+    # NOTE: text mode turns windows CR LF into LF, strip() handles stray CR
+    block: ObjectBlock = None
+    with open(fname, 'r') as config:
+        for lineno, line in enumerate(config, 1):
+            line = line.strip()
+            command, _, value = line.partition(' ')
+            command_lower = command.lower()
+            if not command_lower.startswith('object.'):
+                continue
+            value = value.strip()
+            if command_lower == 'object.create':
+                if block is not None:
+                    yield block
+                block = ObjectBlock(value)
+            elif block is None:
+                logging.warning('%s:%s: %s outside of Object.create block', fname, lineno, command)
+                continue
+            else:
+                try:
+                    if command_lower == 'object.absoluteposition':
+                        block.position = parse_float3(value)
+                    elif command_lower == 'object.rotation':
+                        block.rotation = parse_float3(value)
+                    elif command_lower == 'object.layer':
+                        block.layer = int(value)
+                    elif command_lower == 'object.group':
+                        block.group = int(value)
+                    else:
+                        block.properties[command] = value
+                except ValueError:
+                    logging.warning('%s:%s: could not parse %s, keeping default for %s', fname, lineno, line, block.name)
+            block.lines.append(line)
+    if block is not None:
+        yield block
@@ -0,0 +1,80 @@
+import os
+import logging
+from itertools import groupby
+from typing import Callable, Dict, Iterable, List, Sequence, TextIO
+
+import numpy as np
+
+from bf2config import ObjectBlock
+
+# same as editor output, fixed so configs are byte-stable between runs
+OBJECT_RECORD = '''
+rem *** %s ***
+Object.create %s
+Object.absolutePosition %.3f/%.3f/%.3f
+Object.rotation %.3f/%.3f/%.3f
+Object.layer 1
+Object.group %d
+'''
+
+# records joined per write
+CHUNK_RECORDS = 4096
+
+def format_object(name: str, position: Sequence[float], rotation: Sequence[float], group: int) -> str:
+    return OBJECT_RECORD % (name, name, *position, *rotation, group)
+
+def write_records(
+        configfile: TextIO,
+        names: Sequence[str],
+        positions: np.ndarray,
+        rotations: np.ndarray,
+        groups: np.ndarray,
+        ):
+    # columns go to python floats once, then formatted in chunks
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3).tolist()
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3).tolist()
+    groups = np.asarray(groups, dtype=np.int64).tolist()
+    chunk: List[str] = []
+    for name, position, rotation, group in zip(names, positions, rotations, groups):
+        chunk.append(OBJECT_RECORD % (name, name, *position, *rotation, group))
+        if len(chunk) == CHUNK_RECORDS:
+            configfile.write(''.join(chunk))
+            chunk.clear()
+    configfile.write(''.join(chunk))
+
+def write_staticobjects(configfile: TextIO, staticobjects: Iterable['Staticobject']):
+    # consecutive rows of one table are emitted straight from its columns
+    for table, run in groupby(staticobjects, key=lambda staticobject: staticobject.table):
+        run = list(run)
+        if table is None:
+            write_records(
+                configfile,
+                [staticobject.name for staticobject in run],
+                [[*staticobject.position] for staticobject in run],
+                [[*staticobject.rotation] for staticobject in run],
+                [staticobject.group for staticobject in run])
+            continue
+        rows = np.fromiter((staticobject.row for staticobject in run), dtype=np.intp, count=len(run))
+        write_records(
+            configfile,
+            [table.names[name_id] for name_id in table.name_ids[rows].tolist()],
+            table.positions[rows],
+            table.rotations[rows],
+            table.groups[rows])
+
+def write_group_configs(
+        blocks: Iterable[ObjectBlock],
+        get_path: Callable[[int], os.PathLike],
+        ) -> Dict[int, os.PathLike]:
+    # one pass over blocks, every group file written with a single write
+    # returns group -> path in order groups first appear
+    chunks: Dict[int, List[str]] = {}
+    for block in blocks:
+        chunks.setdefault(block.group, []).append('\n' + '\n'.join(block.lines) + '\n')
+    paths: Dict[int, os.PathLike] = {}
+    for group, group_chunks in chunks.items():
+        paths[group] = get_path(group)
+        logging.info('Writing config for group %s in %s', group, paths[group])
+        with open(paths[group], 'w') as config:
+            config.write(''.join(group_chunks))
+    return paths
@@ -0,0 +1,52 @@
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from staticmesh import StaticMesh
+
+# geom -> merged lod -> (instance, source lod)
+LodPlan = List[List[List[Tuple[int, int]]]]
+
+class ClusterLods(NamedTuple):
+    # members below this share of cluster radius are left out of lod 1,
+    # share doubles with every further lod as screen size halves
+    drop_ratio: float = 0.0
+    # lods added after the last source lod, made of coarsest member lods
+    extra_lods: int = 0
+
+    @property
+    def enabled(self):
+        return self.drop_ratio > 0.0 or self.extra_lods > 0
+
+def get_member_bounds(instances: List[Tuple[StaticMesh, np.ndarray]]) -> Tuple[np.ndarray, float]:
+    # (radius of every member, radius of whole cluster) from lod 0 bounds in base object space
+    centers = np.empty((len(instances), 3))
+    radii = np.empty(len(instances))
+    for instance, (mesh, matrix) in enumerate(instances):
+        lod = mesh.geoms[0][0]
+        low, high = np.asarray(lod.min, dtype=float), np.asarray(lod.max, dtype=float)
+        centers[instance] = matrix[:, :3] @ ((low + high) / 2) + matrix[:, 3]
+        radii[instance] = np.linalg.norm(high - low) / 2
+    low = (centers - radii[:, None]).min(axis=0)
+    high = (centers + radii[:, None]).max(axis=0)
+    return radii, float(np.linalg.norm(high - low) / 2)
+
+def build_lod_plan(instances: List[Tuple[StaticMesh, np.ndarray]], lods: ClusterLods) -> LodPlan:
+    # lod 0 keeps every member, lower lods drop small members and use their own lower lods
+    radii, cluster_radius = get_member_bounds(instances)
+    biggest = int(np.argmax(radii))
+    template = instances[0][0]
+    plan: LodPlan = []
+    for geom in template.geoms:
+        geom_plan: List[List[Tuple[int, int]]] = []
+        for lodId in range(len(geom) + lods.extra_lods):
+            sourceLodId = min(lodId, len(geom) - 1)
+            if lodId == 0:
+                members = list(range(len(instances)))
+            else:
+                threshold = lods.drop_ratio * 2 ** (lodId - 1) * cluster_radius
+                # never empty, biggest member stays
+                members = [instance for instance, radius in enumerate(radii) if radius >= threshold] or [biggest]
+            geom_plan.append([(instance, sourceLodId) for instance in members])
+        plan.append(geom_plan)
+    return plan
@@ -0,0 +1,32 @@
+from typing import Dict, List
+
+class DisjointSet(object):
+    # union-find over 0..size-1 with path halving and union by size
+
+    def __init__(self, size: int):
+        self.parents = list(range(size))
+        self.sizes = [1] * size
+
+    def find(self, id: int) -> int:
+        parents = self.parents
+        while parents[id] != id:
+            parents[id] = parents[parents[id]]
+            id = parents[id]
+        return id
+
+    def union(self, id1: int, id2: int) -> int:
+        root1, root2 = self.find(id1), self.find(id2)
+        if root1 == root2:
+            return root1
+        if self.sizes[root1] < self.sizes[root2]:
+            root1, root2 = root2, root1
+        self.parents[root2] = root1
+        self.sizes[root1] += self.sizes[root2]
+        return root1
+
+    def sets(self) -> List[List[int]]:
+        # ordered by first member, members in ascending order
+        sets: Dict[int, List[int]] = {}
+        for id in range(len(self.parents)):
+            sets.setdefault(self.find(id), []).append(id)
+        return list(sets.values())
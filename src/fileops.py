@@ -0,0 +1,78 @@
+import os
+import errno
+import shutil
+import logging
+from typing import Iterable
+
+import instrument
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux FICLONE ioctl, copy-on-write clone on btrfs/xfs
+FICLONE = 0x40049409
+
+# link or clone not possible here, next method is tried
+LINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY}
+
+def remove_tree(path: os.PathLike):
+    # errors are raised, files left behind could be links into source mod
+    if os.path.lexists(path):
+        shutil.rmtree(path)
+
+def reflink(src: os.PathLike, dst: os.PathLike):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, 'reflink not supported', dst)
+    # exclusive create, existing dst may be hard link sharing data with src
+    with open(src, 'rb') as srcfile, open(dst, 'xb') as dstfile:
+        try:
+            fcntl.ioctl(dstfile.fileno(), FICLONE, srcfile.fileno())
+        except OSError:
+            dstfile.close()
+            os.remove(dst)
+            raise
+
+def link_or_copy(src: os.PathLike, dst: os.PathLike) -> str:
+    # NOTE: hard links share data with source, outputs must never be edited in place
+    if os.path.lexists(dst):
+        # leftover from interrupted or concurrent run, never written through
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return 'linked'
+    except OSError as err:
+        if err.errno not in LINK_UNSUPPORTED:
+            raise
+    try:
+        reflink(src, dst)
+        return 'reflinked'
+    except OSError as err:
+        if err.errno not in LINK_UNSUPPORTED:
+            raise
+    shutil.copy2(src, dst)
+    return 'copied'
+
+def link_tree(
+        src: os.PathLike,
+        dst: os.PathLike,
+        exclude_dirs: Iterable[str] = (),
+        exclude_exts: Iterable[str] = (),
+        ):
+    # directory structure of src with every file linked, excluded top level dirs and extensions skipped
+    exclude_dirs = set(exclude_dirs)
+    exclude_exts = set(exclude_exts)
+    methods = {'linked': 0, 'reflinked': 0, 'copied': 0}
+    for dirname, dirnames, filenames in os.walk(src):
+        if dirname == src:
+            dirnames[:] = [name for name in dirnames if name not in exclude_dirs]
+        dstdir = os.path.join(dst, os.path.relpath(dirname, src))
+        os.makedirs(dstdir, exist_ok=True)
+        for filename in filenames:
+            if os.path.splitext(filename)[1] in exclude_exts:
+                continue
+            methods[link_or_copy(os.path.join(dirname, filename), os.path.join(dstdir, filename))] += 1
+    for method, files in methods.items():
+        instrument.count(f'files_{method}', files)
+    logging.debug('linked %s to %s: %s', src, dst, methods)
@@ -0,0 +1,112 @@
+import os
+import sys
+import random
+import logging
+import argparse
+import tempfile
+from typing import List
+
+import numpy as np
+
+from staticmesh import USAGE_POSITION, StaticMesh, get_instance_matrix, get_rotation_matrix, merge_instances
+from vec3 import Vec3
+
+from benchmark import generate_staticmesh
+from merge import rotate_world_position
+
+def find_meshes(paths: List[os.PathLike]) -> List[str]:
+    meshes: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirname, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                meshes += [os.path.join(dirname, filename) for filename in sorted(filenames) if filename.lower().endswith('.staticmesh')]
+        else:
+            meshes.append(path)
+    return meshes
+
+def check_roundtrip(path: os.PathLike, workdir: os.PathLike) -> bool:
+    # open -> export must give back the same bytes
+    exported = os.path.join(workdir, 'roundtrip.staticmesh')
+    StaticMesh.open(path).export(exported)
+    with open(path, 'rb') as source, open(exported, 'rb') as result:
+        if source.read() == result.read():
+            return True
+    logging.error('%s changes on open -> export', path)
+    return False
+
+def get_random_rotation(rng: random.Random) -> Vec3:
+    # editor snapped angles and arbitrary ones, pitch and roll included
+    return Vec3(*[rng.choice([0.0, 90.0, -90.0, 180.0, rng.uniform(-180, 180)]) for _ in range(3)])
+
+def get_random_position(rng: random.Random) -> Vec3:
+    return Vec3(rng.uniform(-2048, 2048), rng.uniform(0, 200), rng.uniform(-2048, 2048))
+
+def check_rotation(rng: random.Random, samples: int) -> int:
+    # matrix convention against rotate_world_position used for cluster placement
+    failed = 0
+    for _ in range(samples):
+        position, rotation = get_random_position(rng), get_random_rotation(rng)
+        expected = np.asarray([*rotate_world_position(position, rotation)])
+        rotated = get_rotation_matrix(rotation) @ np.asarray([*position])
+        if not np.allclose(rotated, expected, atol=1e-6):
+            logging.error('rotation %s of %s: matrix gives %s, rotate_world_position %s', rotation, position, rotated, expected)
+            failed += 1
+    return failed
+
+def check_merge_transform(rng: random.Random, samples: int, workdir: os.PathLike) -> int:
+    # merged vertex put back into world by base placement lands where member vertex is in world
+    path = os.path.join(workdir, 'transform.staticmesh')
+    generate_staticmesh(path, lods=1, vertices=24, texture='texture.dds')
+    mesh = StaticMesh.open(path)
+    column = mesh.get_columns(USAGE_POSITION)[0]
+    source = mesh.vertices[:, column:column+3].astype(float)
+    failed = 0
+    for _ in range(samples):
+        base_position, base_rotation = get_random_position(rng), get_random_rotation(rng)
+        position, rotation = base_position + Vec3(*[rng.uniform(-50, 50) for _ in range(3)]), get_random_rotation(rng)
+        merged = merge_instances([
+            (mesh, get_instance_matrix(base_position, base_rotation, base_position, base_rotation)),
+            (mesh, get_instance_matrix(position, rotation, base_position, base_rotation)),
+            ])
+        result = merged.vertices[len(source):, column:column+3].astype(float)
+        for vertex, merged_vertex in zip(source, result):
+            expected = np.asarray([*(position + rotate_world_position(Vec3(*vertex), rotation))])
+            world = np.asarray([*(base_position + rotate_world_position(Vec3(*merged_vertex), base_rotation))])
+            # vertices are float32 in base space
+            if not np.allclose(world, expected, atol=1e-3):
+                logging.error('member at %s %s in base at %s %s: vertex lands at %s, expected %s',
+                    position, rotation, base_position, base_rotation, world, expected)
+                failed += 1
+                break
+    return failed
+
+def main(args) -> int:
+    rng = random.Random(args.seed)
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix='levelcompiler-formatcheck-') as workdir:
+        meshes = find_meshes(args.meshes)
+        if not meshes:
+            # synthetic meshes when no game files are given
+            for lods in range(1, 4):
+                path = os.path.join(workdir, f'synthetic{lods}.staticmesh')
+                generate_staticmesh(path, lods=lods, vertices=24 * lods, texture=f'texture{lods}.dds', seed=lods)
+                meshes.append(path)
+        roundtrip_failed = sum(1 for path in meshes if not check_roundtrip(path, workdir))
+        print(f'roundtrip: {len(meshes) - roundtrip_failed} of {len(meshes)} meshes identical')
+        rotation_failed = check_rotation(rng, args.samples)
+        print(f'rotation: {args.samples - rotation_failed} of {args.samples} samples match rotate_world_position')
+        transform_failed = check_merge_transform(rng, args.samples, workdir)
+        print(f'merge transform: {args.samples - transform_failed} of {args.samples} samples match rotate_world_position')
+        failed = roundtrip_failed + rotation_failed + transform_failed
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('meshes', help='Staticmesh files or folders to round-trip, synthetic meshes if none', nargs='*')
+    parser.add_argument('--samples', help='Random placements for rotation and merge transform checks', type=int, default=200)
+    parser.add_argument('--seed', help='Seed for random placements', type=int, default=0)
+    args = parser.parse_args()
+
+    sys.exit(main(args))
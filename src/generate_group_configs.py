@@ -1,42 +1,18 @@
 import os
 import sys
-import re
 import argparse
 import logging
-from typing import DefaultDict, List
-from collections import defaultdict
 
-# couldn't make it work with findall
-def generate_groups_configs(fname: os.PathLike):
-    logging.info(f'Generating groups configs from {fname}')
-    # NOTE: windows using CR LF for ending line, might break pattern
-    # NOTE: pattern relies on linebreak between "create" blocks
-    # Credits: thanks paradisebeyound for pattern
-    pattern_create = r'^Object\.create.*\n(?:Object(?!\.create).*\n?)*'
-    pattern_group = r'^Object\.group (?P<groupid>\d+)'
+from bf2config import iter_object_blocks
+from bf2writer import write_group_configs
 
-    groups: DefaultDict[int, List[str]] = defaultdict(list)
-    with open(fname, 'r') as config:
-        for created in re.finditer(pattern_create, config.read(), re.IGNORECASE | re.MULTILINE):
-            if created:
-                group = re.search(pattern_group, created.group(), re.IGNORECASE | re.MULTILINE)
-                if group:
-                    groupid = int(group.group('groupid'))
-                    groups[groupid].append(created.group())
-                else:
-                    # no group = 0
-                    groups[0].append(created.group())
-    
-    for groupid, blocks in groups.items():
-        root, ext = os.path.splitext(fname)
-        new_fname = root + f'_{groupid}' + ext
-        filename = os.path.basename(new_fname)
-        print(filename)
-        logging.info(f'Writing config for group {groupid} in {new_fname}')
-        with open(new_fname, 'w') as newconfig:
-            for commands in blocks:
-                newconfig.write('\n')
-                newconfig.writelines(commands)
+def generate_groups_configs(fname: os.PathLike):
+    logging.info('Generating groups configs from %s', fname)
+    root, ext = os.path.splitext(fname)
+    # no group = 0
+    paths = write_group_configs(iter_object_blocks(fname), lambda groupid: root + f'_{groupid}' + ext)
+    for new_fname in paths.values():
+        print(os.path.basename(new_fname))
 
 def main(args):
     root = os.path.join('E:/', 'Games', 'Project Reality')
@@ -1,10 +1,26 @@
 import os
 
+from staticmesh import StaticMesh
+
 class Geometry(object):
 
     def __init__(self, name: str, meshpath: os.PathLike):
         self.name = name
         self.path = meshpath
+        self._mesh: StaticMesh = None
+
+    @property
+    def mesh(self) -> StaticMesh:
+        # header, vertex declaration, lod and material tables only, buffers decoded on access
+        if self._mesh is None:
+            self._mesh = StaticMesh.open(self.path)
+        return self._mesh
+
+    def __getstate__(self):
+        # opened meshes are not sent to workers
+        state = self.__dict__.copy()
+        state['_mesh'] = None
+        return state
     
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
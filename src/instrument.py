@@ -0,0 +1,115 @@
+import io
+import os
+import json
+import time
+import pstats
+import cProfile
+import logging
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, DefaultDict, Dict, List
+
+REPORT_VERSION = 1
+
+class lazy(object):
+    # log argument evaluated only when record is formatted
+    __slots__ = ('function',)
+
+    def __init__(self, function: Callable):
+        self.function = function
+
+    def __str__(self):
+        return str(self.function())
+
+def get_profile_summary(profiler: cProfile.Profile, top: int = 20) -> str:
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+    return stream.getvalue()
+
+class Instrumentation(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # stage name -> total seconds
+        self.stages: DefaultDict[str, float] = defaultdict(float)
+        self.counters: DefaultDict[str, int] = defaultdict(int)
+        # chrome trace event format, complete events in microseconds
+        self.events: List[dict] = []
+        self.profiler: cProfile.Profile = None
+        self.memory: Dict[str, object] = {}
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def merge_counters(self, counters: Dict[str, int]):
+        # counters collected in worker processes
+        for name, value in counters.items():
+            self.counters[name] += value
+
+    def reset_counters(self) -> Dict[str, int]:
+        counters = dict(self.counters)
+        self.counters.clear()
+        return counters
+
+    @contextmanager
+    def stage(self, name: str, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.stages[name] += end - start
+            self.events.append({
+                'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                'ts': round((start - self.start) * 1e6), 'dur': round((end - start) * 1e6),
+                'args': args,
+                })
+            logging.info('stage %s took %.3fs', name, end - start)
+
+    def start_profile(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop_profile(self, path: os.PathLike):
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+        logging.info('wrote profile to %s', path)
+        logging.debug('top of profile:\n%s', lazy(lambda profiler=self.profiler: get_profile_summary(profiler)))
+        self.profiler = None
+
+    def start_tracemalloc(self):
+        tracemalloc.start()
+
+    def stop_tracemalloc(self, top: int = 10):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.memory = {
+            'current': current,
+            'peak': peak,
+            'top': [
+                {'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:top]],
+            }
+
+    def report(self) -> dict:
+        return {
+            'version': REPORT_VERSION,
+            'total': time.perf_counter() - self.start,
+            'stages': dict(self.stages),
+            'counters': dict(self.counters),
+            'memory': self.memory,
+            'traceEvents': self.events,
+            }
+
+    def write_report(self, path: os.PathLike):
+        # loads in chrome://tracing and perfetto as is
+        with open(path, 'w') as reportfile:
+            json.dump(self.report(), reportfile, indent=1)
+        logging.info('wrote instrumentation report to %s', path)
+
+# process wide instance, modules only count into it
+instrumentation = Instrumentation()
+stage = instrumentation.stage
+count = instrumentation.count
@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import Callable, Dict, Iterable, List, Optional
+
+from clusterlod import ClusterLods
+from mergecache import MergeCache, get_file_hash
+from mod import get_cache_dir
+from objectTemplate import ObjectTemplate
+from staticobject import Staticobject
+
+# bump when generated output changes for the same inputs
+MANIFEST_VERSION = 2
+
+def get_template_hash(path_object: os.PathLike, file_hash: Callable[[os.PathLike], str] = get_file_hash) -> str:
+    # every file by content, same size textures get replaced too
+    digest = hashlib.blake2b(digest_size=16)
+    for dirname, dirnames, filenames in os.walk(path_object):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirname, filename)
+            relpath = os.path.relpath(path, path_object)
+            digest.update(f'{relpath}:{file_hash(path)}\n'.encode())
+    return digest.hexdigest()
+
+class BuildManifest(object):
+
+    def __init__(
+            self,
+            path: os.PathLike,
+            levelroot: os.PathLike,
+            config_fname: os.PathLike,
+            templates: Dict[str, os.PathLike],
+            mergecache: MergeCache,
+            rebuild=False,
+            lods: ClusterLods = None,
+            ):
+        self.path = path
+        # previous outputs are only used for stale detection
+        self.rebuild = rebuild
+        self.levelroot = levelroot
+        self.config_fname = config_fname
+        self.templates = templates
+        self.mergecache = mergecache
+        self.lods = lods
+        # config fname -> {'clusters': {key: record}, 'collisions': {name: key}}
+        self.configs: Dict[str, Dict[str, dict]] = {}
+        self.clusters: Dict[str, dict] = {}
+        self.collisions: Dict[str, str] = {}
+        self._template_hashes: Dict[str, str] = {}
+        self.load()
+
+    @property
+    def previous(self) -> Dict[str, dict]:
+        return self.configs.get(self.config_fname, {'clusters': {}, 'collisions': {}})
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as manifestfile:
+                manifest = json.load(manifestfile)
+        except (OSError, ValueError) as err:
+            logging.warning('Ignoring unreadable manifest %s: %s', self.path, err)
+            return
+        if manifest.get('version') == MANIFEST_VERSION:
+            self.configs = manifest['configs']
+
+    def save(self):
+        if not self.path:
+            return
+        # other configs of level may have been saved since this one was loaded
+        self.load()
+        self.configs[self.config_fname] = {'clusters': self.clusters, 'collisions': self.collisions}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as manifestfile:
+            json.dump({'version': MANIFEST_VERSION, 'configs': self.configs}, manifestfile, indent=1, sort_keys=True)
+
+    def _get_template_hash(self, name: str) -> str:
+        path_object = os.path.dirname(self.templates[name])
+        if path_object not in self._template_hashes:
+            self._template_hashes[path_object] = get_template_hash(path_object, self.mergecache.get_file_hash)
+        return self._template_hashes[path_object]
+
+    def get_cluster_key(self, cluster: List[Staticobject]) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{MANIFEST_VERSION}\n'.encode())
+        if self.lods and self.lods.enabled:
+            digest.update(f'{tuple(self.lods)}\n'.encode())
+        for staticobject in cluster:
+            digest.update(repr((
+                staticobject.name,
+                [*staticobject.position],
+                [*staticobject.rotation],
+                staticobject.group,
+                self.mergecache.get_hash(staticobject.geometry),
+                self._get_template_hash(staticobject.name),
+                )).encode())
+        return digest.hexdigest()
+
+    def get_content_key(self, cluster: List[Staticobject]) -> str:
+        # mesh and template content of members, lod 0 center offset and so placement depend on it
+        return repr([
+            (self.mergecache.get_hash(staticobject.geometry), self._get_template_hash(staticobject.name))
+            for staticobject in cluster])
+
+    def _exists(self, name: str) -> bool:
+        return os.path.isdir(os.path.join(self.levelroot, 'objects', name))
+
+    def get_cluster(self, cluster: List[Staticobject]) -> Optional[Staticobject]:
+        key = self.get_cluster_key(cluster)
+        record = self.previous['clusters'].get(key)
+        if self.rebuild or not record or not self._exists(record['name']):
+            return None
+        logging.info('cluster %s is up to date', record["name"])
+        staticobject = Staticobject(record['name'])
+        staticobject.setPosition(*record['position'])
+        staticobject.setRotation(*record['rotation'])
+        staticobject.group = record['group']
+        staticobject._template = ObjectTemplate(record['name'])
+        staticobject._template.config = f'objects/{record["name"]}/{record["name"]}.con'
+        self.clusters[key] = record
+        return staticobject
+
+    def add_cluster(self, cluster: List[Staticobject], staticobject: Staticobject):
+        self.clusters[self.get_cluster_key(cluster)] = {
+            'name': staticobject.name,
+            'position': [*staticobject.position],
+            'rotation': [*staticobject.rotation],
+            'group': staticobject.group,
+            'members': [member.name for member in cluster],
+            }
+
+    def get_collision_key(self, staticobject: Staticobject) -> str:
+        return f'{MANIFEST_VERSION}:{self._get_template_hash(staticobject.name)}'
+
+    def has_collision(self, staticobject: Staticobject, name_col: str) -> bool:
+        key = self.get_collision_key(staticobject)
+        if self.rebuild:
+            return False
+        if self.previous['collisions'].get(name_col) == key and self._exists(name_col):
+            logging.info('collision %s is up to date', name_col)
+            self.collisions[name_col] = key
+            return True
+        return False
+
+    def add_collision(self, staticobject: Staticobject, name_col: str):
+        self.collisions[name_col] = self.get_collision_key(staticobject)
+
+    def remove_stale(self, keep: Iterable[str] = ()):
+        # objects folder is shared by every config of the level, keep are names of configs not saved yet
+        self.load()
+        used = set(record['name'] for record in self.clusters.values()) | set(self.collisions) | set(keep)
+        for config_fname, config in self.configs.items():
+            if config_fname != self.config_fname:
+                used |= set(record['name'] for record in config['clusters'].values())
+                used |= set(config['collisions'])
+        previous = self.previous
+        stale = set(record['name'] for record in previous['clusters'].values()) | set(previous['collisions'])
+        for name in sorted(stale - used):
+            path = os.path.join(self.levelroot, 'objects', name)
+            logging.info('removing stale %s', path)
+            shutil.rmtree(path, ignore_errors=True)
+
+def get_build_manifest(
+        modroot: os.PathLike,
+        levelname: str,
+        config_fname: os.PathLike,
+        templates: Dict[str, os.PathLike],
+        mergecache: MergeCache,
+        rebuild=False,
+        lods: ClusterLods = None,
+        ) -> BuildManifest:
+    path = os.path.join(get_cache_dir(modroot), 'levels', f'{levelname}.json')
+    levelroot = os.path.join(modroot, 'levels', levelname)
+    return BuildManifest(path, levelroot, config_fname, templates, mergecache, rebuild, lods)
@@ -1,25 +1,41 @@
 import logging
 import argparse
-import re
 import os
 import sys
-import shutil
-from typing import List, Dict, Tuple
+import hashlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Dict, Iterable, Tuple
 from math import cos, radians, sin
 from itertools import groupby, chain
 from operator import attrgetter
 
-import bf2mesh
-from bf2mesh.visiblemesh import VisibleMesh
-from geometry import Geometry
+import numpy as np
 
-from mod import get_mod_templates, get_mod_geometries
+import instrument
+from instrument import lazy
+
+from mod import ModIndex, get_mod_index
+from mergecache import MergeCache, get_merge_cache
+from meshpool import MeshPool
+from manifest import BuildManifest, get_build_manifest
 from objectTemplate import ObjectTemplate, load_geometries
-from staticobject import Staticobject, parse_config_staticobjects
+from bf2writer import write_staticobjects
+from clusterlod import ClusterLods, build_lod_plan
+from disjointset import DisjointSet
+from fileops import link_tree, remove_tree
+from spatial import ClusterLimits, split_clusters
+from plan import generate_plan, load_plan_clusters, write_plan
+from staticmesh import StaticMesh, get_instance_matrix, get_rotation_matrix, merge_instances
+from staticobject import Staticobject, StaticobjectTable, parse_config_table
+from templatecache import TemplateCache, get_template_cache
+from templaterewriter import REWRITE_REMOVE_COLLISION, REWRITE_REMOVE_VISIBLE, TemplateRewriter
 from vec3 import Vec3
 
+TEMPLATE_CONFIG_EXTS = ['.con', '.tweak']
 
 def get_groups(staticobjects: List[Staticobject]) -> List[List[Staticobject]]:
+    if isinstance(staticobjects, StaticobjectTable):
+        return staticobjects.get_groups()
     return [
         list(group) for _,
         group in groupby(
@@ -33,118 +49,57 @@ def get_unique_collision_staticobjects(clusters: List[List[Staticobject]]) -> Li
     # props to: https://stackoverflow.com/questions/10024646/how-to-get-list-of-objects-with-unique-attribute
     return [seen.add(staticobject.name) or staticobject for staticobject in chain(*clusters) if staticobject.name not in seen]
 
-def generate_renamed_config(
+def rename_template(
         src: os.PathLike,
         dst: os.PathLike,
-        name_old: str,
-        name_new: str,
-        remove_col: bool = False,
-        remove_visible: bool = False,
-        ):
-    patterns_collision = [
-        r'^CollisionManager.*',
-        r'^ObjectTemplate\.collisionMesh.*',
-        r'^ObjectTemplate\.setCollisionMesh.*',
-        r'^ObjectTemplate\.mapMaterial.*',
-        r'^ObjectTemplate\.hasCollisionPhysics.*',
-        r'^ObjectTemplate\.physicsType.*',
-    ]
-    patterns_collision_set = [
-        r'^ObjectTemplate\.collisionMesh.*',
-        r'^ObjectTemplate\.setCollisionMesh.*',
-    ]
-    patterns_visible = [
-        r'^GeometryTemplate.*',
-        r'^ObjectTemplate\.geometry.*',
-        r'^ObjectTemplate\.cullRadiusScale.*',
-    ]
-
-    logging.info(f"generating {dst} with replaced '{name_old}'->'{name_new}' from {dst}")
-    with open(dst, 'w') as newconfig:
-        with open(src, 'r') as oldconfig:
-            contents = oldconfig.read()
-            contents = contents.replace(name_old, name_new)
-            for line in contents.splitlines():
-                if remove_col:
-                    if any([re.findall(pattern, line, re.IGNORECASE)
-                            for pattern in patterns_collision]):
-                        line = 'rem ' + line
-                if remove_visible:
-                    if any([re.findall(pattern, line, re.IGNORECASE)
-                            for pattern in patterns_visible]):
-                        line = 'rem ' + line
-                    # preserve col name
-                    if any([re.findall(pattern, line, re.IGNORECASE)
-                            for pattern in patterns_collision_set]):
-                        line = line.replace(name_new, name_old)
-                newconfig.write(line + '\n')
-
-def rename_template(
-        path_object: os.PathLike,
         old_name: str,
         new_name: str,
-        remove_col: bool = False,
-        remove_visible: bool = False,
+        rewriter: TemplateRewriter,
         ):
-    for dirname, dirnames, filenames in os.walk(path_object):
+    # configs are written straight from source template, meshes are never renamed
+    for dirname, dirnames, filenames in os.walk(src):
+        if dirname == src:
+            dirnames[:] = [name for name in dirnames if name != 'meshes']
+        dstdir = os.path.join(dst, os.path.relpath(dirname, src))
+        os.makedirs(dstdir, exist_ok=True)
         for filename in filenames:
             root, ext = os.path.splitext(filename)
-            if ext in ['.con', '.tweak']:
+            if ext in TEMPLATE_CONFIG_EXTS:
                 old_path = os.path.join(dirname, filename)
                 new_filename = filename.replace(old_name, new_name)
-                new_path = os.path.join(dirname, new_filename)
+                new_path = os.path.join(dstdir, new_filename)
 
-                generate_renamed_config(
-                    old_path, new_path,
-                    old_name, new_name,
-                    remove_col, remove_visible
-                    )
-                logging.info(f'removing {old_path}')
-                os.remove(old_path)
+                rewriter.rewrite(old_path, new_path, old_name, new_name)
 
 def generate_cluster_visiblemesh(
         base: Staticobject,
-        staticobjects: List[Staticobject]
-        ) -> VisibleMesh:
-    logging.info(f'merging meshes {[staticobject.name for staticobject in staticobjects]} into {str(base)}')
-    with VisibleMesh(base.geometry.path) as basemesh:
-        logging.info(f'rotating base {base.name} for {base.rotation}')
-        basemesh.rotate(base.rotation)
-        logging.info(f'translating base {base.name} for {base.position}')
-        basemesh.translate(base.position)
-        for other in staticobjects:
-            with VisibleMesh(other.geometry.path) as secondmesh:
-                logging.info(f'rotating other {other.name} for {other.rotation}')
-                secondmesh.rotate([*other.rotation])
-
-                logging.info(f'translating other {other.name} for {other.position}')
-                secondmesh.translate(other.position)
-
-                logging.info(f'merging {other.name} into {base.name}')
-                basemesh.merge(secondmesh)
-        logging.info(f'translating base {base.name} for {-base.position}')
-        basemesh.translate(-base.position)
-
-        logging.info(f'rotating base {base.name} for {-base.rotation}')
-        basemesh.rotate(-base.rotation)
-    
-    return basemesh
+        staticobjects: List[Staticobject],
+        meshpool: MeshPool,
+        lods: ClusterLods = None,
+        ) -> StaticMesh:
+    logging.info('merging meshes %s into %s', lazy(lambda: [staticobject.name for staticobject in staticobjects]), base)
+    # every instance goes straight into base object space with a single transform
+    instances = [
+        (meshpool.get(staticobject.geometry), get_instance_matrix(
+            staticobject.position, staticobject.rotation,
+            base.position, base.rotation))
+        for staticobject in [base, *staticobjects]]
+    if lods and lods.enabled:
+        return merge_instances(instances, build_lod_plan(instances, lods))
+    return merge_instances(instances)
 
 def copy_object_to_level(src, dst):
     # cleanup first
-    logging.info(f'removing {dst}, ignore_errors')
-    shutil.rmtree(dst, ignore_errors=True)
+    logging.info('removing %s', dst)
+    remove_tree(dst)
 
-    logging.info(f'copy {src} to {dst}')
-    shutil.copytree(src, dst, dirs_exist_ok=True)
+    # meshes are regenerated and configs rewritten, everything else links to source
+    logging.info('linking %s to %s', src, dst)
+    link_tree(src, dst, exclude_dirs=['meshes'], exclude_exts=TEMPLATE_CONFIG_EXTS)
 
-def remove_meshes(path_object: os.PathLike):
-    path_meshes = os.path.join(path_object, 'meshes')
-    logging.info(f'removing {path_meshes}')
-    shutil.rmtree(path_meshes, ignore_errors=True)
-
-def get_merged_name(staticobject: Staticobject):
-    return f'{staticobject.name}_merged={"=".join([str(round(axis)) for axis in staticobject.position])}'
+def get_merged_name(base: Staticobject, key: str) -> str:
+    # named by merged geometry, regenerated cluster never overwrites template another kept cluster places
+    return f'{base.name}_merged={hashlib.blake2b(key.encode(), digest_size=6).hexdigest()}'
 
 def rotate_world_position(position: Vec3, rotation: Vec3) -> Vec3:
     def Rpitch(position: Vec3, angle):
@@ -168,7 +123,7 @@ def rotate_world_position(position: Vec3, rotation: Vec3) -> Vec3:
 
         return Vec3(newX, newY, newZ)
 
-    logging.debug(f'rotating at {position} by {rotation}')
+    logging.debug('rotating at %s by %s', position, rotation)
     yaw, pitch, roll = [radians(axis) for axis in rotation]
 
     return Ryaw(Rpitch(Rroll(position, roll), pitch), yaw)
@@ -177,25 +132,27 @@ def generate_custom_cluster_object(
         cluster: List[Staticobject],
         templates: Dict[str, os.PathLike],
         levelroot: os.PathLike, 
+        meshpool: MeshPool,
+        lods: ClusterLods = None,
+        name_cluster: str = None,
         ) -> Staticobject:
     base = cluster[0]
-    mesh_cluster = generate_cluster_visiblemesh(base, cluster[1:])
+    if name_cluster is None:
+        name_cluster = get_merged_name(base, get_cluster_shape_key(cluster, lods))
+    mesh_cluster = generate_cluster_visiblemesh(base, cluster[1:], meshpool, lods)
     
     # needed due to mesh culling when looking away
     offset = Vec3(*mesh_cluster.get_lod_center_offset(geomId=0, lodId=0))
-    logging.info(f'translating mesh centerToObject by {str(offset)}')
+    logging.info('translating mesh centerToObject by %s', offset)
     mesh_cluster.translate(-offset)
 
     cluster_staticobject = Staticobject(base.name)
-    # rotate object world to object space, apply offset, rorate back
-    new_position = rotate_world_position(base.position, -base.rotation)
-    new_position += offset
-    new_position = rotate_world_position(new_position, base.rotation)
-    logging.info(f'new position {base.position} -> {new_position}')
+    # offset is in object space, rotate it to world
+    new_position = base.position + rotate_world_position(offset, base.rotation)
+    logging.info('new position %s -> %s', base.position, new_position)
     cluster_staticobject.setPosition(*new_position)
     cluster_staticobject.setRotation(*base.rotation)
     cluster_staticobject.group = base.group
-    name_cluster = get_merged_name(cluster_staticobject)
     cluster_staticobject.name = name_cluster
     cluster_staticobject._template = ObjectTemplate(name_cluster)
     cluster_staticobject._template.config = f'objects/{name_cluster}/{name_cluster}.con'
@@ -203,28 +160,229 @@ def generate_custom_cluster_object(
     src = os.path.dirname(templates[base.name])
     dst = os.path.join(levelroot, 'objects', name_cluster)
     copy_object_to_level(src, dst)
-    remove_meshes(dst)
 
     export_path = os.path.join(dst, 'meshes', name_cluster+'.staticmesh')
-    logging.info(f'exporting cluster into {export_path}')
+    logging.info('exporting cluster into %s', export_path)
     mesh_cluster.export(export_path)
 
-    rename_template(dst, base.name, name_cluster, remove_col=True)
+    rename_template(src, dst, base.name, name_cluster, REWRITE_REMOVE_COLLISION)
     return cluster_staticobject
 
+# per-process state for parallel cluster generation
+_worker_state: Dict[str, object] = {}
+
+def _init_cluster_worker(
+        templates: Dict[str, os.PathLike],
+        meshpool_capacity: int,
+        ):
+    _worker_state['templates'] = templates
+    _worker_state['meshpool'] = MeshPool(meshpool_capacity)
+
+def _generate_custom_cluster_object_worker(
+        cluster: List[Staticobject],
+        levelroot: os.PathLike,
+        lods: ClusterLods,
+        name_cluster: str,
+        ) -> Tuple[Staticobject, Dict[str, int]]:
+    # counters go back to parent with result, forked workers start from parent counts
+    instrument.instrumentation.reset_counters()
+    staticobject = generate_custom_cluster_object(
+        cluster,
+        _worker_state['templates'],
+        levelroot,
+        _worker_state['meshpool'],
+        lods,
+        name_cluster)
+    return staticobject, instrument.instrumentation.reset_counters()
+
+def get_cluster_executor(
+        templates: Dict[str, os.PathLike],
+        meshpool: MeshPool,
+        jobs: int,
+        ) -> ProcessPoolExecutor:
+    # not bound to a level, one pool can serve every level of a mod
+    # workers split the mesh pool cap so whole run stays within it
+    return ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_cluster_worker,
+        initargs=(templates, meshpool.capacity // jobs))
+
+def submit_cluster(
+        executor: ProcessPoolExecutor,
+        cluster: List[Staticobject],
+        levelroot: os.PathLike,
+        lods: ClusterLods,
+        name_cluster: str,
+        ) -> Future:
+    # result is (merged object, worker counters)
+    return executor.submit(_generate_custom_cluster_object_worker, cluster, levelroot, lods, name_cluster)
+
+def generate_clusters_parallel(
+        clusters: List[List[Staticobject]],
+        levelroot: os.PathLike,
+        executor: ProcessPoolExecutor,
+        lods: ClusterLods = None,
+        names: List[str] = None,
+        ) -> List[Staticobject]:
+    if names is None:
+        names = [get_merged_name(cluster[0], get_cluster_shape_key(cluster, lods)) for cluster in clusters]
+    # executor.map keeps cluster order, config output matches serial run
+    generated: List[Staticobject] = []
+    for staticobject, counters in executor.map(
+            _generate_custom_cluster_object_worker, clusters,
+            [levelroot] * len(clusters), [lods] * len(clusters), names):
+        instrument.instrumentation.merge_counters(counters)
+        generated.append(staticobject)
+    return generated
+
+def get_cluster_shape_key(cluster: List[Staticobject], lods: ClusterLods = None) -> str:
+    # base and member templates in base object space, clusters with equal keys merge into equal meshes
+    # template names and not mesh paths, merged names stay same wherever mod is checked out
+    base = cluster[0]
+    members = sorted(
+        (staticobject.name, tuple(np.round(get_instance_matrix(
+            staticobject.position, staticobject.rotation,
+            base.position, base.rotation), 3).ravel() + 0.0))
+        for staticobject in cluster[1:])
+    return repr((base.name, members, tuple(lods) if lods and lods.enabled else None))
+
+def place_cluster_object(
+        cluster: List[Staticobject],
+        shared: Staticobject,
+        shared_base: Staticobject,
+        ) -> Staticobject:
+    # instance of already generated merged template, moved and turned along with cluster base
+    base = cluster[0]
+    offset = get_rotation_matrix(shared_base.rotation).T @ np.asarray([*(shared.position - shared_base.position)])
+    new_position = base.position + Vec3(*(get_rotation_matrix(base.rotation) @ offset))
+    logging.info('placing %s at %s for %s', shared.name, new_position, base.name)
+    cluster_staticobject = Staticobject(shared.name)
+    cluster_staticobject.setPosition(*new_position)
+    cluster_staticobject.setRotation(*base.rotation)
+    cluster_staticobject.group = base.group
+    cluster_staticobject._template = ObjectTemplate(shared.name)
+    cluster_staticobject._template.config = f'objects/{shared.name}/{shared.name}.con'
+    return cluster_staticobject
+
+class VisiblePlan(object):
+    # merged objects of clusters reused from manifest and the unique clusters left to generate
+
+    def __init__(self, clusters: List[List[Staticobject]]):
+        self.clusters = clusters
+        # None until reused or generated
+        self.merged: List[Staticobject] = [None] * len(clusters)
+        self.pending: List[List[Staticobject]] = []
+        self.unique: List[List[Staticobject]] = []
+        # merged template name of every unique cluster
+        self.names: List[str] = []
+        self.keys: Dict[int, str] = {}
+        # shape key -> (cluster, merged object) of the template every equal cluster places
+        self.shapes: Dict[str, Tuple[List[Staticobject], Staticobject]] = {}
+
+    @property
+    def used_names(self) -> List[str]:
+        # merged folders this plan places, reused ones and those still generated
+        return [merged.name for merged in self.merged if merged is not None] + self.names
+
+def plan_visible(
+        clusters: List[List[Staticobject]],
+        manifest: BuildManifest = None,
+        dedup: bool = True,
+        lods: ClusterLods = None,
+        ) -> VisiblePlan:
+    plan = VisiblePlan(clusters)
+    plan.merged = [manifest.get_cluster(cluster) if manifest else None for cluster in clusters]
+    plan.pending = [cluster for cluster, merged in zip(clusters, plan.merged) if merged is None]
+    logging.info('%s of %s clusters need rebuilding', len(plan.pending), len(clusters))
+
+    for cluster in clusters:
+        plan.keys[id(cluster)] = get_cluster_shape_key(cluster, lods)
+        if manifest:
+            # changed sources get new folder, other configs keep placing the old one until they are rebuilt
+            plan.keys[id(cluster)] += manifest.get_content_key(cluster)
+        if not dedup:
+            # every cluster exports own template
+            base = cluster[0]
+            plan.keys[id(cluster)] += repr(([*base.position], [*base.rotation], base.group))
+    if dedup:
+        for cluster, merged in zip(clusters, plan.merged):
+            if merged is not None:
+                plan.shapes.setdefault(plan.keys[id(cluster)], (cluster, merged))
+        for cluster in plan.pending:
+            key = plan.keys[id(cluster)]
+            if key not in plan.shapes:
+                plan.shapes[key] = (cluster, None)
+                plan.unique.append(cluster)
+        logging.info('%s of %s pending clusters have unique geometry', len(plan.unique), len(plan.pending))
+    else:
+        plan.unique = plan.pending
+    plan.names = [get_merged_name(cluster[0], plan.keys[id(cluster)]) for cluster in plan.unique]
+    return plan
+
+def place_visible(
+        plan: VisiblePlan,
+        generated: List[Staticobject],
+        manifest: BuildManifest = None,
+        ) -> List[Staticobject]:
+    # generated follows plan.unique, every other pending cluster places template of its shape
+    instrument.count('clusters_generated', len(generated))
+    instrument.count('clusters_reused', len(plan.clusters) - len(plan.pending))
+    instrument.count('clusters_deduplicated', len(plan.pending) - len(plan.unique))
+    generated_by_cluster = {id(cluster): merged for cluster, merged in zip(plan.unique, generated)}
+    for key, (cluster, merged) in plan.shapes.items():
+        if merged is None:
+            plan.shapes[key] = (cluster, generated_by_cluster[id(cluster)])
+    pending_ids = set(id(cluster) for cluster in plan.pending)
+    for id_cluster, cluster in enumerate(plan.clusters):
+        if id(cluster) not in pending_ids:
+            continue
+        if id(cluster) in generated_by_cluster:
+            plan.merged[id_cluster] = generated_by_cluster[id(cluster)]
+        else:
+            shared_cluster, shared = plan.shapes[plan.keys[id(cluster)]]
+            plan.merged[id_cluster] = place_cluster_object(cluster, shared, shared_cluster[0])
+        if manifest:
+            manifest.add_cluster(cluster, plan.merged[id_cluster])
+    return plan.merged
+
+def generate_unique(
+        plan: VisiblePlan,
+        templates: Dict[str, os.PathLike],
+        levelroot: os.PathLike,
+        meshpool: MeshPool,
+        jobs: int = 1,
+        executor: ProcessPoolExecutor = None,
+        lods: ClusterLods = None,
+        ) -> List[Staticobject]:
+    unique, names = plan.unique, plan.names
+    if executor is not None and len(unique) > 1:
+        logging.info('generating %s clusters with shared worker pool', len(unique))
+        return generate_clusters_parallel(unique, levelroot, executor, lods, names)
+    if jobs > 1 and len(unique) > 1:
+        logging.info('generating %s clusters with %s jobs', len(unique), jobs)
+        with get_cluster_executor(templates, meshpool, jobs) as executor:
+            return generate_clusters_parallel(unique, levelroot, executor, lods, names)
+    generated: List[Staticobject] = []
+    for cluster, name_cluster in zip(unique, names):
+        logging.info('generating merged visiblemesh for %s', lazy(lambda: [str(staticobject) for staticobject in cluster]))
+        generated.append(generate_custom_cluster_object(cluster, templates, levelroot, meshpool, lods, name_cluster))
+    return generated
+
 def generate_visible(
         clusters: List[List[Staticobject]],
         templates: Dict[str, os.PathLike],
         levelroot: os.PathLike,
+        meshpool: MeshPool,
+        jobs: int = 1,
+        manifest: BuildManifest = None,
+        dedup: bool = True,
+        executor: ProcessPoolExecutor = None,
+        lods: ClusterLods = None,
         ) -> List[Staticobject]:
-    logging.info(f'generating merged visiblemeshes')
-    merged_cluster: List[Staticobject] = []
-    for cluster in clusters:
-        logging.info(f'generating merged visiblemesh for {[str(staticobject) for staticobject in cluster]}')
-        merged = generate_custom_cluster_object(cluster, templates, levelroot)
-        merged_cluster.append(merged)
-    
-    return merged_cluster
+    logging.info('generating merged visiblemeshes')
+    plan = plan_visible(clusters, manifest, dedup, lods)
+    generated = generate_unique(plan, templates, levelroot, meshpool, jobs, executor, lods)
+    return place_visible(plan, generated, manifest)
 
 def get_col_name(staticobject: Staticobject):
     return f'{staticobject.name}_col'
@@ -233,32 +391,48 @@ def generate_custom_collision_object(
         staticobject: Staticobject,
         templates: Dict[str, os.PathLike],
         levelroot: os.PathLike,
+        templatecache: TemplateCache = None,
         ):
     src = os.path.dirname(templates[staticobject.name])
     name_col = get_col_name(staticobject)
     dst = os.path.join(levelroot, 'objects', name_col)
-    copy_object_to_level(src, dst)
-    remove_meshes(dst)
 
-    rename_template(dst, staticobject.name, name_col, remove_visible=True)
+    def generate(path: os.PathLike):
+        copy_object_to_level(src, path)
+        rename_template(src, path, staticobject.name, name_col, REWRITE_REMOVE_VISIBLE)
+
+    # same for every level, only depends on source template
+    if templatecache:
+        templatecache.materialize(src, name_col, REWRITE_REMOVE_VISIBLE.rules, dst, generate)
+    else:
+        generate(dst)
 
 def generate_custom_collision_objects(
         clusters: List[List[Staticobject]],
         templates: Dict[str, os.PathLike],
         levelroot: os.PathLike,
+        manifest: BuildManifest = None,
+        templatecache: TemplateCache = None,
         ):
     unique_collisions_staticobjects = get_unique_collision_staticobjects(clusters)
-    logging.info(f'unique collisions: {[_.name for _ in unique_collisions_staticobjects]}')
+    logging.info('unique collisions: %s', lazy(lambda: [_.name for _ in unique_collisions_staticobjects]))
     for staticobject in unique_collisions_staticobjects:
-        generate_custom_collision_object(staticobject, templates, levelroot)
+        name_col = get_col_name(staticobject)
+        if manifest and manifest.has_collision(staticobject, name_col):
+            continue
+        generate_custom_collision_object(staticobject, templates, levelroot, templatecache)
+        if manifest:
+            manifest.add_collision(staticobject, name_col)
 
 def generate_collisions(
         clusters: List[List[Staticobject]],
         templates: Dict[str, os.PathLike],
         levelroot: os.PathLike,
+        manifest: BuildManifest = None,
+        templatecache: TemplateCache = None,
         ) -> List[Staticobject]:
-    logging.info(f'generating invinsible collisions')
-    generate_custom_collision_objects(clusters, templates, levelroot)
+    logging.info('generating invinsible collisions')
+    generate_custom_collision_objects(clusters, templates, levelroot, manifest, templatecache)
 
 def generate_includes_for_bf2editor(cluster: List[Staticobject]) -> List[str]:
     lines: List[str] = []
@@ -266,7 +440,7 @@ def generate_includes_for_bf2editor(cluster: List[Staticobject]) -> List[str]:
     lines.append('console.allowMultipleFileLoad 0\n')
     for staticobject in cluster:
         if staticobject.template and staticobject.template.config:
-            logging.info(f'run[{staticobject.name}] {staticobject.template.config}')
+            logging.info('run[%s] %s', staticobject.name, staticobject.template.config)
             lines.append(f'run {staticobject.template.config}\n')
     lines.append('console.allowMultipleFileLoad 1\n')
     lines.append('endIf\n')
@@ -280,11 +454,11 @@ def generate_config(
         levelroot: os.PathLike,
         config_fname: os.PathLike,
         ):
-    logging.info(f'generating configs from {[cluster for cluster in zip(cluster_visible, cluster_collisions)]}')
+    logging.info('generating configs from %s', lazy(lambda: [cluster for cluster in zip(cluster_visible, cluster_collisions)]))
 
     config_name, ext = os.path.splitext(config_fname)
     configpath = os.path.join(levelroot, f'{config_name}_merged{ext}')
-    logging.info(f'writing config to {configpath}')
+    logging.info('writing config to %s', configpath)
     with open(configpath, 'w') as clusterconfig:
         #logging.info(f'writing config to {configpath}')
         generated_cluster: List[Staticobject] = []
@@ -311,73 +485,167 @@ def generate_config(
             generated_cluster.append(staticobject)
         
         clusterconfig.writelines(generate_includes_for_bf2editor(generated_cluster))
-        
-        for staticobject in generated_cluster:
-            clusterconfig.write(staticobject.generateCreateCommands())
+        write_staticobjects(clusterconfig, generated_cluster)
 
 def get_clusters(
         groups: List[List[Staticobject]],
-        templates: Dict[str, os.PathLike],
-        geometries: Dict[str, Geometry],
+        mergecache: MergeCache,
         ):
-    logging.info(f'Testing merges in {[[staticobject.name for staticobject in group] for group in groups]}')
+    logging.info('Testing merges in %s', lazy(lambda: [[staticobject.name for staticobject in group] for group in groups]))
 
     clusters: List[List[Staticobject]] = []
-    tests: Dict[Tuple[Tuple, Tuple], bool] = {}
     for group in groups:
-        for id1, staticobject in enumerate(group):
-            cluster: List[Staticobject] = []
-            for id2, other in enumerate(group):
-                test = (
-                    (staticobject.geometry, other.geometry),
-                    (other.geometry, staticobject.geometry),
-                )
-                if test in tests.keys():
-                    if tests[test]:
-                        logging.info(
-                            f'skipping merge test [{id1}]{staticobject.geometry} and [{id2}]{other.geometry}, adding [{id2}]{other} into cluster')
-                        cluster.append(other)
-                else:
-                    with VisibleMesh(staticobject.geometry.path) as basemesh:
-                        with VisibleMesh(other.geometry.path) as othermesh:
-                            if basemesh.canMerge(othermesh):
-                                logging.info(
-                                    f'can merge [{id1}]{staticobject.geometry} and [{id2}]{other.geometry}, adding [{id2}]{other} into cluster')
-                                cluster.append(other)
-                                tests[test] = True
-                            else:
-                                logging.info(
-                                    f'cannot merge [{id1}]{staticobject.geometry} and [{id2}]{other.geometry}, skipping [{id2}]{other.geometry}')
-                                tests[test] = False
-            if cluster not in clusters:
+        # one pass over group, objects joined with first object of same merge signature
+        members = DisjointSet(len(group))
+        first: Dict[int, int] = {}
+        for id, staticobject in enumerate(group):
+            signature = mergecache.get_signature(staticobject.geometry)
+            logging.info('%s has merge signature %s', staticobject.geometry, signature)
+            members.union(first.setdefault(signature, id), id)
+        for ids in members.sets():
+            if len(ids) > 1:
+                cluster = [group[id] for id in ids]
                 clusters.append(cluster)
-                logging.info(f'added cluster {[_.name for _ in cluster]}')
+                logging.info('added cluster %s', lazy(lambda: [_.name for _ in cluster]))
 
-    return [cluster for cluster in clusters if len(cluster) > 1]
+    return clusters
 
-def generate_merged(
+def get_single_objects(
+        staticobjects: List[Staticobject],
+        clusters: List[List[Staticobject]],
+        ) -> List[Staticobject]:
+    clustered = set(id(staticobject) for cluster in clusters for staticobject in cluster)
+    return [staticobject for staticobject in staticobjects if id(staticobject) not in clustered]
+
+def get_merge_clusters(
+        table: StaticobjectTable,
+        mergecache: MergeCache,
+        meshpool: MeshPool,
+        limits: ClusterLimits = None,
+        ) -> List[List[Staticobject]]:
+    groups = get_groups(table)
+    clusters = get_clusters(groups, mergecache)
+    if limits and limits.enabled:
+        clusters = split_clusters(clusters, limits, meshpool.get_size)
+    return clusters
+
+def generate_merge_plan(
         modroot: os.PathLike,
         levelname: str,
         config_fname: os.PathLike,
-        templates: Dict[str, os.PathLike],
-        geometries: Dict[str, Geometry],
-        ):
+        modindex: ModIndex,
+        mergecache: MergeCache,
+        meshpool: MeshPool,
+        limits: ClusterLimits = None,
+        lods: ClusterLods = None,
+        ) -> dict:
+    levelroot = os.path.join(modroot, 'levels', levelname)
+    table = parse_config_table(os.path.join(levelroot, config_fname))
+    load_geometries(table, modindex)
+
+    clusters = get_merge_clusters(table, mergecache, meshpool, limits)
+    return generate_plan(levelname, config_fname, clusters, meshpool.get_header, limits, lods)
+
+class MergeJob(object):
+    # group config between clustering and config output, visible clusters are generated in between
+
+    def __init__(
+            self,
+            levelname: str,
+            config_fname: os.PathLike,
+            levelroot: os.PathLike,
+            clusters: List[List[Staticobject]],
+            single_objects: List[Staticobject],
+            manifest: BuildManifest,
+            visible: VisiblePlan,
+            ):
+        self.levelname = levelname
+        self.config_fname = config_fname
+        self.levelroot = levelroot
+        self.clusters = clusters
+        self.single_objects = single_objects
+        self.manifest = manifest
+        self.visible = visible
+
+def prepare_merged(
+        modroot: os.PathLike,
+        levelname: str,
+        config_fname: os.PathLike,
+        modindex: ModIndex,
+        mergecache: MergeCache,
+        meshpool: MeshPool,
+        rebuild: bool = False,
+        limits: ClusterLimits = None,
+        plan: os.PathLike = None,
+        dedup: bool = True,
+        lods: ClusterLods = None,
+        ) -> MergeJob:
     levelroot = os.path.join(modroot, 'levels', levelname)
     config_group = os.path.join(levelroot, config_fname)
 
-    staticobjects = parse_config_staticobjects(config_group)
+    with instrument.stage('parse', config=config_group):
+        table = parse_config_table(config_group)
+        staticobjects = table.staticobjects
+    instrument.count('staticobjects', len(table))
 
     #load_templates(staticobjects, templates)
-    load_geometries(staticobjects, templates, geometries)
-
-    dst = os.path.join(levelroot, 'objects')
-    groups = get_groups(staticobjects)
-    clusters = get_clusters(groups, templates, geometries)
-    single_objects = [staticobject for staticobject in staticobjects if staticobject not in chain(*clusters)]
+    with instrument.stage('geometries'):
+        load_geometries(table, modindex)
+
+    with instrument.stage('clusters'):
+        if plan:
+            clusters = load_plan_clusters(plan, table, levelname, config_fname)
+        else:
+            clusters = get_merge_clusters(table, mergecache, meshpool, limits)
+        single_objects = get_single_objects(staticobjects, clusters)
+    instrument.count('clusters', len(clusters))
+
+    manifest = get_build_manifest(modroot, levelname, config_fname, modindex.templates, mergecache, rebuild, lods)
+    logging.info('generating merged visiblemeshes')
+    visible = plan_visible(clusters, manifest, dedup, lods)
+    return MergeJob(levelname, config_fname, levelroot, clusters, single_objects, manifest, visible)
+
+def finish_merged(
+        job: MergeJob,
+        generated: List[Staticobject],
+        templates: Dict[str, os.PathLike],
+        templatecache: TemplateCache = None,
+        keep: Iterable[str] = (),
+        ):
+    # generated follows job.visible.unique, keep are level objects other unfinished jobs still place
+    visible = place_visible(job.visible, generated, job.manifest)
+    with instrument.stage('collisions'):
+        generate_collisions(job.clusters, templates, job.levelroot, job.manifest, templatecache)
+    with instrument.stage('manifest'):
+        job.manifest.remove_stale(keep)
+        job.manifest.save()
+    with instrument.stage('config'):
+        generate_config(visible, job.clusters, job.single_objects, job.levelroot, job.config_fname)
 
-    visible = generate_visible(clusters, templates, levelroot)
-    generate_collisions(clusters, templates, levelroot)
-    generate_config(visible, clusters, single_objects, levelroot, config_fname)
+def generate_merged(
+        modroot: os.PathLike,
+        levelname: str,
+        config_fname: os.PathLike,
+        modindex: ModIndex,
+        mergecache: MergeCache,
+        meshpool: MeshPool,
+        jobs: int = 1,
+        rebuild: bool = False,
+        limits: ClusterLimits = None,
+        plan: os.PathLike = None,
+        dedup: bool = True,
+        templatecache: TemplateCache = None,
+        executor: ProcessPoolExecutor = None,
+        lods: ClusterLods = None,
+        ):
+    templates = modindex.templates
+    job = prepare_merged(
+        modroot, levelname, config_fname, modindex, mergecache, meshpool,
+        rebuild, limits, plan, dedup, lods)
+    with instrument.stage('visible', jobs=jobs):
+        generated = generate_unique(job.visible, templates, job.levelroot, meshpool, jobs, executor, lods)
+    logging.info('mesh pool: %s loads, %s reuses', meshpool.misses, meshpool.hits)
+    finish_merged(job, generated, templates, templatecache)
 
 def main(args):
     args.root = os.path.join('E:/', 'Games', 'Project Reality')
@@ -387,21 +655,58 @@ def main(args):
 
     modroot = os.path.join(args.root, args.modPath)
 
-    logging.info(f'Merging meshes from {modroot}/levels/{args.level}/{args.fname}')
+    logging.info('Merging meshes from %s/levels/%s/%s', modroot, args.level, args.fname)
+    instrumentation = instrument.instrumentation
+    if args.profile:
+        instrumentation.start_profile()
+    if args.tracemalloc:
+        instrumentation.start_tracemalloc()
+    try:
+        return run(args, modroot)
+    finally:
+        if args.profile:
+            instrumentation.stop_profile(args.profile)
+        if args.tracemalloc:
+            instrumentation.stop_tracemalloc()
+        if args.report:
+            instrumentation.write_report(args.report)
+
+def run(args, modroot: os.PathLike):
     try:
-        geometries = get_mod_geometries(modroot)
-        configs = get_mod_templates(modroot)
+        with instrument.stage('index'):
+            modindex = get_mod_index(modroot, cache=not args.no_cache, jobs=args.jobs)
+        mergecache = get_merge_cache(modroot, cache=not args.no_cache)
+        meshpool = MeshPool(args.mesh_pool_size * 1024 * 1024)
+        templatecache = get_template_cache(modroot, cache=not args.no_cache, mergecache=mergecache)
 
-        generate_merged(modroot, args.level, args.fname, configs, geometries)
+        try:
+            limits = ClusterLimits(args.max_cluster_radius, args.max_cluster_vertices, args.max_cluster_indices)
+            lods = ClusterLods(args.cluster_lod_drop_ratio, args.cluster_extra_lods)
+            if args.plan:
+                plan = generate_merge_plan(
+                    modroot, args.level, args.fname,
+                    modindex, mergecache, meshpool, limits, lods)
+                write_plan(args.plan, plan)
+                print(f'{len(plan["clusters"])} clusters planned, {plan["over_budget"]} over budget')
+                return 1 if plan['over_budget'] else 0
+            generate_merged(
+                modroot, args.level, args.fname,
+                modindex, mergecache, meshpool,
+                args.jobs, args.rebuild, limits, args.from_plan, not args.no_dedup, templatecache,
+                lods=lods)
+        finally:
+            mergecache.save()
     except Exception as err:
-        logging.critical(f'Failed to generate merge from {args.fname}', exc_info=err)
+        logging.critical('Failed to generate merge from %s', args.fname, exc_info=err)
+        return 1
+    return 0
 
     # group objects in editor by mapper
     # generate merge plan:
     #   1. generate json with clusters
     #   2. preflight checks:
     #       merge sizes(indices are 32k)
-    #       LM merged size <=2k
+    #       TODO: LM merged size <=2k, needs lightmap data not in mesh headers
     #   3. generate colmeshes without visible geometry
     #   4. merge meshes
     # ...
@@ -447,7 +752,22 @@ if __name__ == "__main__":
     parser.add_argument('--modPath', help="Path to mod relative to game root")
     parser.add_argument('--root', help="Path to game directory")
     parser.add_argument('--in', help="Path to staticobjects.con with groups")
+    parser.add_argument('--no-cache', help="Ignore cached mod index, merge tests and collision templates", action='store_true')
+    parser.add_argument('-j', '--jobs', help="Number of worker processes", type=int, default=1)
+    parser.add_argument('--rebuild', help="Regenerate every cluster even if unchanged", action='store_true')
+    parser.add_argument('--max-cluster-radius', help="Split clusters wider than this radius in meters", type=float)
+    parser.add_argument('--max-cluster-vertices', help="Split clusters with more vertices", type=int)
+    parser.add_argument('--max-cluster-indices', help="Split clusters with more indices", type=int)
+    parser.add_argument('--plan', help="Write cluster plan with preflight checks to this json and exit")
+    parser.add_argument('--from-plan', help="Merge only validated clusters from plan json")
+    parser.add_argument('--no-dedup', help="Export every cluster even if another one has same geometry", action='store_true')
+    parser.add_argument('--cluster-lod-drop-ratio', help="Leave members smaller than this share of cluster radius out of lod 1, doubling every lower lod", type=float, default=0.0)
+    parser.add_argument('--cluster-extra-lods', help="Add this many lods after the last source lod from coarsest member lods", type=int, default=0)
+    parser.add_argument('--report', help="Write stage timings and counters as json/trace events to this path")
+    parser.add_argument('--profile', help="Write cProfile stats of whole run to this path")
+    parser.add_argument('--tracemalloc', help="Add peak memory and top allocations to report", action='store_true')
+    parser.add_argument('--mesh-pool-size', help="Memory cap in MB for pooled source meshes, split between worker processes with -j", type=int, default=512)
     args = parser.parse_args()
     set_logging(args)
 
-    main(args)
+    sys.exit(main(args))
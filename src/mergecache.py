@@ -0,0 +1,108 @@
+import os
+import hashlib
+import logging
+from typing import Dict, Tuple
+
+import instrument
+from geometry import Geometry
+from staticmesh import StaticMesh
+
+from mod import get_cache_dir, load_cache, save_cache
+
+MERGE_CACHE_VERSION = 2
+
+def get_file_hash(path: os.PathLike) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as meshfile:
+        for chunk in iter(lambda: meshfile.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_mesh_signature(mesh: StaticMesh) -> tuple:
+    # meshes merge when vertex layout and geom/lod structure match
+    return (
+        mesh.version,
+        tuple(len(geom) for geom in mesh.geoms),
+        tuple(mesh.vertattribs),
+        mesh.vertformat,
+        mesh.vertstride,
+        )
+
+class MergeCache(object):
+
+    def __init__(self, cachepath: os.PathLike = None):
+        self.cachepath = cachepath
+        # file path -> (mtime_ns, size, content hash), meshes and template files
+        self.hashes: Dict[str, Tuple[int, int, str]] = {}
+        # meshpath -> (mtime_ns, size, mesh signature)
+        self.layouts: Dict[str, Tuple[int, int, tuple]] = {}
+        # meshpaths already checked against disk in this run
+        self._checked: Dict[str, str] = {}
+        self._checked_layouts: Dict[str, tuple] = {}
+        # mesh signature -> compatibility class
+        self.signatures: Dict[tuple, int] = {}
+        self._changed = False
+        if cachepath:
+            self.load()
+
+    def load(self):
+        cache = load_cache(self.cachepath, MERGE_CACHE_VERSION)
+        if cache:
+            self.hashes = cache['hashes']
+            self.layouts = cache['layouts']
+            logging.info('Loaded %s mesh signatures from %s', len(self.layouts), self.cachepath)
+
+    def save(self):
+        if self.cachepath and self._changed:
+            logging.info('Saving %s mesh signatures to %s', len(self.layouts), self.cachepath)
+            save_cache(self.cachepath, MERGE_CACHE_VERSION, hashes=self.hashes, layouts=self.layouts)
+            self._changed = False
+
+    def get_hash(self, geometry: Geometry) -> str:
+        return self.get_file_hash(geometry.path)
+
+    def get_file_hash(self, path: os.PathLike) -> str:
+        # content hash, reread only when mtime or size changed
+        if path in self._checked:
+            return self._checked[path]
+        stat = os.stat(path)
+        record = self.hashes.get(path)
+        if record and record[:2] == (stat.st_mtime_ns, stat.st_size):
+            filehash = record[2]
+        else:
+            filehash = get_file_hash(path)
+            instrument.count('files_hashed')
+            instrument.count('bytes_hashed', stat.st_size)
+            self.hashes[path] = (stat.st_mtime_ns, stat.st_size, filehash)
+            self._changed = True
+        self._checked[path] = filehash
+        return filehash
+
+    def get_layout(self, geometry: Geometry) -> tuple:
+        # only mesh tables are read, never whole files
+        if geometry.path in self._checked_layouts:
+            return self._checked_layouts[geometry.path]
+        stat = os.stat(geometry.path)
+        record = self.layouts.get(geometry.path)
+        if record and record[:2] == (stat.st_mtime_ns, stat.st_size):
+            layout = record[2]
+        else:
+            layout = get_mesh_signature(geometry.mesh)
+            instrument.count('mesh_layouts_read')
+            self.layouts[geometry.path] = (stat.st_mtime_ns, stat.st_size, layout)
+            self._changed = True
+        self._checked_layouts[geometry.path] = layout
+        return layout
+
+    def get_signature(self, geometry: Geometry) -> int:
+        # compatibility is an equivalence on layouts, one class id per distinct layout
+        instrument.count('merge_signatures')
+        layout = self.get_layout(geometry)
+        if layout not in self.signatures:
+            self.signatures[layout] = len(self.signatures)
+        return self.signatures[layout]
+
+def get_merge_cache(modroot: os.PathLike, cache=True) -> MergeCache:
+    if not cache:
+        return MergeCache()
+    return MergeCache(os.path.join(get_cache_dir(modroot), 'meshes.pickle'))
@@ -0,0 +1,50 @@
+import logging
+from collections import OrderedDict
+from typing import Tuple
+
+import instrument
+from geometry import Geometry
+from staticmesh import StaticMesh
+
+class MeshPool(object):
+
+    def __init__(self, capacity: int = 512 * 1024 * 1024):
+        # bytes of mesh buffers kept before least recently used are dropped
+        self.capacity = capacity
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # meshpath -> parsed mesh
+        self._meshes: 'OrderedDict[str, StaticMesh]' = OrderedDict()
+
+    def get(self, geometry: Geometry) -> StaticMesh:
+        # pooled meshes are shared and read-only, transforms always write new arrays
+        mesh = self._meshes.get(geometry.path)
+        if mesh is not None:
+            self.hits += 1
+            self._meshes.move_to_end(geometry.path)
+            return mesh
+
+        self.misses += 1
+        instrument.count('meshes_loaded')
+        logging.info('loading %s into mesh pool', geometry.path)
+        mesh = StaticMesh.open(geometry.path)
+        self._meshes[geometry.path] = mesh
+        self.size += mesh.nbytes
+        self._evict()
+        return mesh
+
+    def get_header(self, geometry: Geometry) -> StaticMesh:
+        # tables only, kept on the geometry for the whole run
+        return self._meshes.get(geometry.path) or geometry.mesh
+
+    def get_size(self, geometry: Geometry) -> Tuple[int, int]:
+        # (vertices, indices)
+        mesh = self.get_header(geometry)
+        return mesh.vertnum, mesh.indexnum
+
+    def _evict(self):
+        while self.size > self.capacity and len(self._meshes) > 1:
+            path, mesh = self._meshes.popitem(last=False)
+            self.size -= mesh.nbytes
+            logging.debug('evicted %s from mesh pool', path)
@@ -1,50 +1,161 @@
 import os
 import re
+import pickle
 import logging
-from typing import Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 from geometry import Geometry
 
-def get_mod_geometries(modroot: os.PathLike, ignore_missing=True):
-    logging.info(f'Searching for geometries in {modroot}')
-    pattern_geometry_create = r'GeometryTemplate.create StaticMesh (?P<filename>\S+)'
-    meshes: Dict[str, Geometry] = {}
-    scanpath = os.path.join(modroot, 'objects')
-    for dirname, dirnames, filenames in os.walk(scanpath):
-        for filename in filenames:
-            if filename.endswith('.con'):
-                configpath = os.path.join(scanpath, dirname, filename)
-                with open(configpath, 'r') as config:
-                    staticmeshes = re.findall(pattern_geometry_create, config.read())
-                    if staticmeshes:
-                        for staticmesh in staticmeshes:
-                            meshpath = os.path.join(scanpath, dirname, 'meshes', staticmesh+'.staticmesh')
-                            if not os.path.exists(meshpath):
-                                message = f"{configpath}: Missing mesh '{staticmesh}'"
-                                logging.warning(message)
-                                if not ignore_missing:
-                                    raise FileNotFoundError(message)
-                            else:
-                                meshes[staticmesh] = Geometry(staticmesh, meshpath)
-                                logging.info(f"Found geometry '{staticmesh}' in {meshpath}")
-    return meshes
-
-def get_mod_templates(modroot: os.PathLike):
-    pattern_template_create = r'ObjectTemplate.create (?P<ObjectType>\S+) (?P<ObjectName>\S+)'
-    templates: Dict[str, os.PathLike] = {}
-    scanpath = os.path.join(modroot, 'objects')
-    for dirname, dirnames, filenames in os.walk(scanpath):
-        for filename in filenames:
-            if filename.endswith('.con'):
-                configpath = os.path.join(scanpath, dirname, filename)
-                with open(configpath, 'r') as config:
-                    created = re.findall(pattern_template_create, config.read())
-                    if created:
-                        for create in created:
-                            # AttributeError: 'tuple' object has no attribute 'group'
-                            #template = create.group('ObjectName')
-                            bf2type = create[0]
-                            template = create[1]
-                            templates[template] = configpath
-                            logging.info(f'Loaded {bf2type} {template} from {configpath}')
-    return templates
+CACHE_DIRNAME = '.levelcompiler'
+INDEX_CACHE_VERSION = 1
+
+pattern_template_create = re.compile(r'ObjectTemplate.create (?P<ObjectType>\S+) (?P<ObjectName>\S+)')
+pattern_geometry_create = re.compile(r'GeometryTemplate.create StaticMesh (?P<filename>\S+)')
+pattern_template_geometry = re.compile(r'ObjectTemplate\.geometry (?P<geometry>\S+)', re.IGNORECASE | re.MULTILINE)
+
+class ConfigEntry(NamedTuple):
+    # (bf2type, name) for each ObjectTemplate.create
+    templates: Tuple[Tuple[str, str], ...]
+    # names from GeometryTemplate.create StaticMesh
+    geometries: Tuple[str, ...]
+    # first ObjectTemplate.geometry in config
+    geometry: Optional[str]
+
+def parse_config_objects(configpath: os.PathLike) -> ConfigEntry:
+    with open(configpath, 'r') as config:
+        contents = config.read()
+    templates = tuple(pattern_template_create.findall(contents))
+    geometries = tuple(pattern_geometry_create.findall(contents))
+    match = pattern_template_geometry.search(contents)
+    return ConfigEntry(templates, geometries, match.group('geometry') if match else None)
+
+def parse_configs(configpaths: List[os.PathLike], jobs: int = 1) -> List[ConfigEntry]:
+    # executor.map keeps input order, so results merge exactly like the serial scan
+    if jobs > 1 and len(configpaths) > 1:
+        chunksize = max(1, len(configpaths) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(parse_config_objects, configpaths, chunksize=chunksize))
+    return [parse_config_objects(configpath) for configpath in configpaths]
+
+def walk_configs(scanpath: os.PathLike) -> List[Tuple[str, int, int]]:
+    # (configpath, mtime_ns, size), sorted so duplicate templates always resolve to the same config
+    configs: List[Tuple[str, int, int]] = []
+    subdirs: List[str] = []
+    with os.scandir(scanpath) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.name.endswith('.con'):
+                stat = entry.stat()
+                configs.append((entry.path, stat.st_mtime_ns, stat.st_size))
+    for subdir in subdirs:
+        configs.extend(walk_configs(subdir))
+    return configs
+
+def get_cache_dir(modroot: os.PathLike):
+    return os.path.join(modroot, CACHE_DIRNAME)
+
+def load_cache(cachepath: os.PathLike, version: int):
+    try:
+        with open(cachepath, 'rb') as cachefile:
+            cache = pickle.load(cachefile)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        logging.warning('Ignoring unreadable cache %s: %s', cachepath, err)
+        return None
+    if not isinstance(cache, dict) or cache.get('version') != version:
+        logging.info('Ignoring outdated cache %s', cachepath)
+        return None
+    return cache
+
+def save_cache(cachepath: os.PathLike, version: int, **contents):
+    os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+    tmppath = cachepath + '.tmp'
+    with open(tmppath, 'wb') as cachefile:
+        pickle.dump(dict(contents, version=version), cachefile, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmppath, cachepath)
+
+class ModIndex(object):
+
+    def __init__(self, modroot: os.PathLike):
+        self.modroot = modroot
+        self.templates: Dict[str, os.PathLike] = {}
+        self.geometries: Dict[str, Geometry] = {}
+        # template name -> geometry name
+        self.template_geometries: Dict[str, str] = {}
+
+    @property
+    def scanpath(self):
+        return os.path.join(self.modroot, 'objects')
+
+    @property
+    def cachepath(self):
+        return os.path.join(get_cache_dir(self.modroot), 'modindex.pickle')
+
+    def scan(self, ignore_missing=True, cache=True, jobs=1):
+        logging.info('Indexing objects in %s', self.scanpath)
+        cached: Dict[str, Tuple[int, int, ConfigEntry]] = {}
+        if cache:
+            cached = (load_cache(self.cachepath, INDEX_CACHE_VERSION) or {}).get('configs', {})
+
+        walked = walk_configs(self.scanpath)
+        keys = [os.path.relpath(configpath, self.scanpath) for configpath, _, _ in walked]
+        changed = [
+            configpath for key, (configpath, mtime, size) in zip(keys, walked)
+            if cached.get(key, (None, None))[:2] != (mtime, size)]
+        logging.info('Parsing %s of %s configs with %s jobs', len(changed), len(walked), jobs)
+        parsed = dict(zip(changed, parse_configs(changed, jobs)))
+
+        # relative config path -> (mtime_ns, size, entry)
+        configs: Dict[str, Tuple[int, int, ConfigEntry]] = {}
+        for key, (configpath, mtime, size) in zip(keys, walked):
+            entry = parsed[configpath] if configpath in parsed else cached[key][2]
+            configs[key] = (mtime, size, entry)
+            self._add_config(configpath, entry, ignore_missing)
+
+        if cache and (parsed or len(configs) != len(cached)):
+            logging.info('Saving mod index cache to %s', self.cachepath)
+            save_cache(self.cachepath, INDEX_CACHE_VERSION, configs=configs)
+        return self
+
+    def _add_config(self, configpath: os.PathLike, entry: ConfigEntry, ignore_missing=True):
+        dirname = os.path.dirname(configpath)
+        for staticmesh in entry.geometries:
+            meshpath = os.path.join(dirname, 'meshes', staticmesh+'.staticmesh')
+            if not os.path.exists(meshpath):
+                message = f"{configpath}: Missing mesh '{staticmesh}'"
+                logging.warning(message)
+                if not ignore_missing:
+                    raise FileNotFoundError(message)
+            else:
+                self.geometries[staticmesh] = Geometry(staticmesh, meshpath)
+                logging.info("Found geometry '%s' in %s", staticmesh, meshpath)
+        for bf2type, template in entry.templates:
+            self.templates[template] = configpath
+            if entry.geometry:
+                self.template_geometries[template] = entry.geometry
+            else:
+                self.template_geometries.pop(template, None)
+            logging.info('Loaded %s %s from %s', bf2type, template, configpath)
+
+    def get_geometry(self, template: str) -> Geometry:
+        try:
+            geometryname = self.template_geometries[template]
+            geometry = self.geometries[geometryname]
+        except KeyError:
+            errmsg = f'could not find mesh path for {template}'
+            logging.error(errmsg)
+            raise FileNotFoundError(errmsg)
+        logging.info('Found geometry %s for %s', geometryname, template)
+        return geometry
+
+def get_mod_index(modroot: os.PathLike, ignore_missing=True, cache=True, jobs=1) -> ModIndex:
+    return ModIndex(modroot).scan(ignore_missing, cache, jobs)
+
+def get_mod_geometries(modroot: os.PathLike, ignore_missing=True, cache=True):
+    return get_mod_index(modroot, ignore_missing, cache).geometries
+
+def get_mod_templates(modroot: os.PathLike, cache=True):
+    return get_mod_index(modroot, cache=cache).templates
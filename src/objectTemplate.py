@@ -1,15 +1,20 @@
 import os
-from typing import List, Dict
+from typing import List
 
-from staticobject import Staticobject
+from staticobject import Staticobject, StaticobjectTable
+from mod import ModIndex
 
 def load_geometries(
         staticobjects: List[Staticobject],
-        templates: Dict[str, os.PathLike],
-        geometries: Dict[str, os.PathLike],
+        modindex: ModIndex,
         ):
+    if isinstance(staticobjects, StaticobjectTable):
+        # once per distinct template
+        for name_id, name in enumerate(staticobjects.names):
+            staticobjects.name_geometries[name_id] = modindex.get_geometry(name)
+        return
     for staticobject in staticobjects:
-        staticobject._setGeometry(templates[staticobject.name], geometries)
+        staticobject._setGeometry(modindex.get_geometry(staticobject.name))
 
 class ObjectTemplate(object):
 
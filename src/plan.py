@@ -0,0 +1,131 @@
+import os
+import json
+import logging
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from clusterlod import ClusterLods, build_lod_plan
+from geometry import Geometry
+from spatial import ClusterLimits
+from staticmesh import MAX_MATERIAL_VERTICES, StaticMesh, get_identity_lod_plan, get_instance_matrix
+from staticobject import Staticobject, StaticobjectTable
+
+PLAN_VERSION = 2
+
+def estimate_cluster(
+        cluster: List[Staticobject],
+        get_header: Callable[[Geometry], StaticMesh],
+        limits: ClusterLimits = None,
+        lods: ClusterLods = None,
+        ) -> dict:
+    # sizes after merge from mesh headers only, materials packed the same way merge_instances does
+    base = cluster[0]
+    instances = [
+        (get_header(staticobject.geometry), get_instance_matrix(
+            staticobject.position, staticobject.rotation,
+            base.position, base.rotation))
+        for staticobject in cluster]
+    if lods and lods.enabled:
+        lod_plan = build_lod_plan(instances, lods)
+    else:
+        lod_plan = get_identity_lod_plan(instances)
+    vertices, indices, drawcalls, max_material_vertices = 0, 0, 0, 0
+    for geomId, geom_plan in enumerate(lod_plan):
+        for lodId, members in enumerate(geom_plan):
+            # material key -> vertices of every merged material it is split into
+            packed: Dict[tuple, List[int]] = {}
+            for instance, sourceLodId in members:
+                for material in instances[instance][0].geoms[geomId][sourceLodId].materials:
+                    parts = packed.setdefault(material.key, [])
+                    if not parts or parts[-1] + material.vnum > MAX_MATERIAL_VERTICES:
+                        parts.append(0)
+                    parts[-1] += material.vnum
+                    vertices += material.vnum
+                    indices += material.inum
+            for parts in packed.values():
+                max_material_vertices = max(max_material_vertices, *parts)
+            if geomId == 0 and lodId == 0:
+                # closest lod is what gets drawn most
+                drawcalls = sum(len(parts) for parts in packed.values())
+
+    issues: List[str] = []
+    if limits and limits.vertices is not None and vertices > limits.vertices:
+        issues.append(f'{vertices} vertices exceeds {limits.vertices}')
+    if limits and limits.indices is not None and indices > limits.indices:
+        issues.append(f'{indices} indices exceeds {limits.indices}')
+
+    return {
+        'name': cluster[0].name,
+        'group': cluster[0].group,
+        'members': [
+            {
+                'row': staticobject.row,
+                'name': staticobject.name,
+                'position': [*staticobject.position],
+                'rotation': [*staticobject.rotation],
+            }
+            for staticobject in cluster],
+        'vertices': vertices,
+        'indices': indices,
+        'drawcalls': drawcalls,
+        'max_material_vertices': max_material_vertices,
+        'issues': issues,
+        }
+
+def generate_plan(
+        levelname: str,
+        config_fname: os.PathLike,
+        clusters: List[List[Staticobject]],
+        get_header: Callable[[Geometry], StaticMesh],
+        limits: ClusterLimits = None,
+        lods: ClusterLods = None,
+        ) -> dict:
+    planned = [estimate_cluster(cluster, get_header, limits, lods) for cluster in clusters]
+    for cluster in planned:
+        for issue in cluster['issues']:
+            logging.warning('cluster %s in group %s: %s', cluster["name"], cluster["group"], issue)
+    return {
+        'version': PLAN_VERSION,
+        'level': levelname,
+        'config': config_fname,
+        'clusters': planned,
+        'over_budget': sum(1 for cluster in planned if cluster['issues']),
+        }
+
+def write_plan(path: os.PathLike, plan: dict):
+    logging.info('writing plan for %s clusters to %s', len(plan["clusters"]), path)
+    with open(path, 'w') as planfile:
+        json.dump(plan, planfile, indent=1)
+
+def load_plan_clusters(
+        path: os.PathLike,
+        table: StaticobjectTable,
+        levelname: str,
+        config_fname: os.PathLike,
+        ) -> List[List[Staticobject]]:
+    # only clusters without preflight issues are returned
+    with open(path, 'r') as planfile:
+        plan = json.load(planfile)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError(f'{path}: unsupported plan version {plan.get("version")}')
+    if (plan['level'], plan['config']) != (levelname, config_fname):
+        raise ValueError(f'{path}: plan is for {plan["level"]}/{plan["config"]}, not {levelname}/{config_fname}')
+
+    clusters: List[List[Staticobject]] = []
+    for planned in plan['clusters']:
+        if planned['issues']:
+            logging.warning('skipping cluster %s: %s', planned["name"], "; ".join(planned["issues"]))
+            continue
+        cluster: List[Staticobject] = []
+        for member in planned['members']:
+            row = member['row']
+            # objects moved or turned since planning change cluster bounds and budgets
+            if (not 0 <= row < len(table)
+                    or table[row].name != member['name']
+                    or not np.allclose(table.positions[row], member['position'], atol=1e-3)
+                    or not np.allclose(table.rotations[row], member['rotation'], atol=1e-3)):
+                raise ValueError(f'{path}: plan does not match config at row {row} ({member["name"]}), replan')
+            cluster.append(table[row])
+        clusters.append(cluster)
+    return clusters
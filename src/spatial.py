@@ -0,0 +1,77 @@
+import logging
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from geometry import Geometry
+from instrument import lazy
+from staticobject import Staticobject
+
+class ClusterLimits(NamedTuple):
+    # max half-diagonal of member positions bounds, in meters
+    radius: Optional[float] = None
+    vertices: Optional[int] = None
+    indices: Optional[int] = None
+
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in self)
+
+def _exceeds(limits: ClusterLimits, positions: np.ndarray, vertices: np.ndarray, indices: np.ndarray) -> bool:
+    if limits.radius is not None:
+        extent = positions.max(axis=0) - positions.min(axis=0)
+        if np.linalg.norm(extent) / 2 > limits.radius:
+            return True
+    if limits.vertices is not None and vertices.sum() > limits.vertices:
+        return True
+    if limits.indices is not None and indices.sum() > limits.indices:
+        return True
+    return False
+
+def split_cluster(
+        cluster: List[Staticobject],
+        limits: ClusterLimits,
+        get_size: Callable[[Geometry], Tuple[int, int]],
+        ) -> List[List[Staticobject]]:
+    # k-d style bisection at the median of the longest axis until every part fits,
+    # each level is linear so whole split is O(n log n)
+    positions = np.array([[*staticobject.position] for staticobject in cluster], dtype=np.float64).reshape(-1, 3)
+    sizes = np.array([get_size(staticobject.geometry) for staticobject in cluster], dtype=np.int64).reshape(-1, 2)
+
+    parts: List[np.ndarray] = []
+    pending = [np.arange(len(cluster))]
+    while pending:
+        ids = pending.pop()
+        if len(ids) < 2 or not _exceeds(limits, positions[ids], sizes[ids, 0], sizes[ids, 1]):
+            parts.append(ids)
+            continue
+        extent = positions[ids].max(axis=0) - positions[ids].min(axis=0)
+        axis = int(np.argmax(extent))
+        half = len(ids) // 2
+        order = np.argpartition(positions[ids, axis], half, kind='introselect')
+        # right half pushed first so parts come out left to right
+        pending.append(np.sort(ids[order[half:]]))
+        pending.append(np.sort(ids[order[:half]]))
+
+    return [[cluster[id] for id in ids] for ids in parts]
+
+def split_clusters(
+        clusters: List[List[Staticobject]],
+        limits: ClusterLimits,
+        get_size: Callable[[Geometry], Tuple[int, int]],
+        ) -> List[List[Staticobject]]:
+    sizes: Dict[str, Tuple[int, int]] = {}
+
+    def get_size_cached(geometry: Geometry):
+        if geometry.path not in sizes:
+            sizes[geometry.path] = get_size(geometry)
+        return sizes[geometry.path]
+
+    split: List[List[Staticobject]] = []
+    for cluster in clusters:
+        parts = split_cluster(cluster, limits, get_size_cached)
+        if len(parts) > 1:
+            logging.info('split cluster of %s into %s', len(cluster), lazy(lambda: [len(part) for part in parts]))
+        # single leftovers are placed as they are
+        split.extend(part for part in parts if len(part) > 1)
+    return split
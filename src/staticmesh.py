@@ -0,0 +1,441 @@
+import os
+import mmap
+import struct
+import logging
+from typing import List, Tuple
+
+import numpy as np
+
+import instrument
+
+# D3DDECLUSAGE
+USAGE_POSITION = 0
+USAGE_NORMAL = 3
+USAGE_TANGENT = 6
+# D3DDECLTYPE
+TYPE_FLOAT3 = 2
+# attribute table terminator
+FLAG_END = 255
+
+# indices are 32k, see TODO in merge.main
+MAX_MATERIAL_VERTICES = 32767
+
+class _Reader(object):
+
+    def __init__(self, buffer, offset: int = 0):
+        self.buffer = buffer
+        self.offset = offset
+
+    def unpack(self, fmt: str) -> tuple:
+        values = struct.unpack_from(fmt, self.buffer, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def read_bytes(self, length: int) -> bytes:
+        value = bytes(self.buffer[self.offset:self.offset+length])
+        self.offset += length
+        return value
+
+    def read_int(self) -> int:
+        return self.unpack('<I')[0]
+
+    def read_string(self) -> str:
+        return self.read_bytes(self.read_int()).decode('latin-1')
+
+    def read_array(self, dtype: str, count: int) -> np.ndarray:
+        array = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.offset)
+        self.offset += array.nbytes
+        return array
+
+    def skip(self, length: int):
+        self.offset += length
+
+class _Writer(object):
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def pack(self, fmt: str, *values):
+        self.chunks.append(struct.pack(fmt, *values))
+
+    def write_int(self, value: int):
+        self.pack('<I', value)
+
+    def write_string(self, value: str):
+        encoded = value.encode('latin-1')
+        self.write_int(len(encoded))
+        self.chunks.append(encoded)
+
+    def write_array(self, array: np.ndarray, dtype: str):
+        # buffers are written as they are, not copied into bytes
+        self.chunks.append(memoryview(np.ascontiguousarray(array, dtype=dtype).reshape(-1).view('u1')))
+
+class Material(object):
+
+    def __init__(self):
+        self.alphamode = 0
+        self.fxfile = ''
+        self.technique = ''
+        self.maps: List[str] = []
+        self.vstart = 0
+        self.istart = 0
+        self.inum = 0
+        self.vnum = 0
+        self.u4 = 0
+        self.u5 = 0
+        self.u6 = 0
+        self.mmin = (0.0, 0.0, 0.0)
+        self.mmax = (0.0, 0.0, 0.0)
+
+    @property
+    def key(self):
+        # materials with the same key render the same and can share a drawcall
+        return (self.alphamode, self.fxfile, self.technique, tuple(self.maps))
+
+class Lod(object):
+
+    def __init__(self):
+        self.min = (0.0, 0.0, 0.0)
+        self.max = (0.0, 0.0, 0.0)
+        self.pivot = (0.0, 0.0, 0.0)
+        self.nodes: np.ndarray = np.zeros((0, 16), dtype='<f4')
+        self.materials: List[Material] = []
+
+class StaticMesh(object):
+
+    def __init__(self):
+        # u1, version, u3, u4, u5
+        self.head: Tuple[int, int, int, int, int] = (0, 11, 0, 0, 0)
+        self.u1 = 0
+        # lods per geom
+        self.geoms: List[List[Lod]] = []
+        # (flag, offset, vartype, usage)
+        self.vertattribs: List[Tuple[int, int, int, int]] = []
+        self.vertformat = 4
+        self.vertstride = 0
+        # vertnum x (vertstride / vertformat) floats, decoded on first access for opened meshes
+        self._vertices: np.ndarray = np.zeros((0, 0), dtype='<f4')
+        self._index: np.ndarray = np.zeros(0, dtype='<u2')
+        self._vertnum = 0
+        self._indexnum = 0
+        self.u2 = 8
+        # source file and buffer offsets for lazy decoding
+        self._path: os.PathLike = None
+        self._vertices_offset = 0
+        self._index_offset = 0
+
+    @property
+    def version(self):
+        return self.head[1]
+
+    @property
+    def vertnum(self):
+        return self._vertnum
+
+    @property
+    def indexnum(self):
+        return self._indexnum
+
+    @property
+    def vertices(self) -> np.ndarray:
+        if self._vertices is None:
+            self._load_buffers()
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices: np.ndarray):
+        self._vertices = vertices
+        self._vertnum = len(vertices)
+
+    @property
+    def index(self) -> np.ndarray:
+        if self._index is None:
+            self._load_buffers()
+        return self._index
+
+    @index.setter
+    def index(self, index: np.ndarray):
+        self._index = index
+        self._indexnum = len(index)
+
+    @property
+    def lods(self) -> List[Lod]:
+        return [lod for geom in self.geoms for lod in geom]
+
+    def get_columns(self, *usages: int) -> List[int]:
+        # first float column of each float3 attribute with given usage
+        return [
+            offset // self.vertformat for flag, offset, vartype, usage in self.vertattribs
+            if flag != FLAG_END and vartype == TYPE_FLOAT3 and usage in usages]
+
+    @classmethod
+    def open(cls, path: os.PathLike) -> 'StaticMesh':
+        # only tables are parsed here, vertex and index buffers are mapped when first used
+        mesh = cls()
+        mesh._path = path
+        with open(path, 'rb') as meshfile:
+            with mmap.mmap(meshfile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                reader = _Reader(buffer)
+                mesh._read(reader)
+        instrument.count('mesh_tables_read')
+        instrument.count('mesh_bytes_read', reader.offset - mesh.nbytes)
+        return mesh
+
+    def _load_buffers(self):
+        # zero-copy views over the mapped file, mapping lives as long as the views
+        with open(self._path, 'rb') as meshfile:
+            buffer = mmap.mmap(meshfile.fileno(), 0, access=mmap.ACCESS_READ)
+        instrument.count('mesh_buffers_mapped')
+        instrument.count('mesh_bytes_mapped', self.nbytes)
+        columns = self.vertstride // self.vertformat
+        if self._vertices is None:
+            self._vertices = np.frombuffer(
+                buffer, dtype='<f4', count=self._vertnum * columns,
+                offset=self._vertices_offset).reshape(self._vertnum, columns)
+        if self._index is None:
+            self._index = np.frombuffer(buffer, dtype='<u2', count=self._indexnum, offset=self._index_offset)
+
+    def _read(self, reader: _Reader):
+        self.head = reader.unpack('<5I')
+        # stupid little byte that misaligns the entire file
+        self.u1, = reader.unpack('<B')
+        geomnum = reader.read_int()
+        lodnums = [reader.read_int() for _ in range(geomnum)]
+        self.geoms = [[Lod() for _ in range(lodnum)] for lodnum in lodnums]
+        vertattribnum = reader.read_int()
+        self.vertattribs = [reader.unpack('<4H') for _ in range(vertattribnum)]
+        self.vertformat = reader.read_int()
+        self.vertstride = reader.read_int()
+        self._vertnum = reader.read_int()
+        self._vertices = None
+        self._vertices_offset = reader.offset
+        reader.skip(self._vertnum * self.vertstride)
+        self._indexnum = reader.read_int()
+        self._index = None
+        self._index_offset = reader.offset
+        reader.skip(self._indexnum * 2)
+        self.u2 = reader.read_int()
+        for lod in self.lods:
+            lod.min = reader.unpack('<3f')
+            lod.max = reader.unpack('<3f')
+            if self.version <= 6:
+                lod.pivot = reader.unpack('<3f')
+            nodenum = reader.read_int()
+            lod.nodes = reader.read_array('<f4', nodenum * 16).reshape(nodenum, 16).copy()
+        for lod in self.lods:
+            lod.materials = [self._read_material(reader) for _ in range(reader.read_int())]
+
+    def _read_material(self, reader: _Reader) -> Material:
+        material = Material()
+        material.alphamode = reader.read_int()
+        material.fxfile = reader.read_string()
+        material.technique = reader.read_string()
+        material.maps = [reader.read_string() for _ in range(reader.read_int())]
+        material.vstart, material.istart, material.inum, material.vnum = reader.unpack('<4I')
+        material.u4, material.u5, material.u6 = reader.unpack('<I2H')
+        if self.version == 11:
+            material.mmin = reader.unpack('<3f')
+            material.mmax = reader.unpack('<3f')
+        return material
+
+    def export(self, path: os.PathLike):
+        writer = _Writer()
+        writer.pack('<5I', *self.head)
+        writer.pack('<B', self.u1)
+        writer.write_int(len(self.geoms))
+        for geom in self.geoms:
+            writer.write_int(len(geom))
+        writer.write_int(len(self.vertattribs))
+        for vertattrib in self.vertattribs:
+            writer.pack('<4H', *vertattrib)
+        writer.write_int(self.vertformat)
+        writer.write_int(self.vertstride)
+        writer.write_int(self.vertnum)
+        writer.write_array(self.vertices, '<f4')
+        writer.write_int(len(self.index))
+        writer.write_array(self.index, '<u2')
+        writer.write_int(self.u2)
+        for lod in self.lods:
+            writer.pack('<3f', *lod.min)
+            writer.pack('<3f', *lod.max)
+            if self.version <= 6:
+                writer.pack('<3f', *lod.pivot)
+            writer.write_int(len(lod.nodes))
+            writer.write_array(lod.nodes, '<f4')
+        for lod in self.lods:
+            writer.write_int(len(lod.materials))
+            for material in lod.materials:
+                writer.write_int(material.alphamode)
+                writer.write_string(material.fxfile)
+                writer.write_string(material.technique)
+                writer.write_int(len(material.maps))
+                for texture in material.maps:
+                    writer.write_string(texture)
+                writer.pack('<4I', material.vstart, material.istart, material.inum, material.vnum)
+                writer.pack('<I2H', material.u4, material.u5, material.u6)
+                if self.version == 11:
+                    writer.pack('<3f', *material.mmin)
+                    writer.pack('<3f', *material.mmax)
+        logging.info('writing %s vertices, %s indices to %s', self.vertnum, len(self.index), path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as meshfile:
+            meshfile.writelines(writer.chunks)
+        instrument.count('meshes_written')
+        instrument.count('mesh_bytes_written', sum(len(chunk) for chunk in writer.chunks))
+
+    @property
+    def nbytes(self):
+        return self.vertnum * self.vertstride + self.indexnum * 2
+
+    def translate(self, offset):
+        if not self.vertices.flags.writeable:
+            self.vertices = self.vertices.copy()
+        for column in self.get_columns(USAGE_POSITION):
+            self.vertices[:, column:column+3] += np.asarray([*offset], dtype='<f4')
+        self.update_bounds()
+
+    def update_bounds(self):
+        column, = self.get_columns(USAGE_POSITION)
+        positions = self.vertices[:, column:column+3]
+        for lod in self.lods:
+            lodmin, lodmax = None, None
+            for material in lod.materials:
+                if not material.vnum:
+                    continue
+                vertices = positions[material.vstart:material.vstart+material.vnum]
+                material.mmin = tuple(float(value) for value in vertices.min(axis=0))
+                material.mmax = tuple(float(value) for value in vertices.max(axis=0))
+                lodmin = material.mmin if lodmin is None else tuple(map(min, lodmin, material.mmin))
+                lodmax = material.mmax if lodmax is None else tuple(map(max, lodmax, material.mmax))
+            if lodmin is not None:
+                lod.min, lod.max = lodmin, lodmax
+
+    def get_lod_center_offset(self, geomId: int = 0, lodId: int = 0) -> Tuple[float, float, float]:
+        lod = self.geoms[geomId][lodId]
+        return tuple((low + high) / 2 for low, high in zip(lod.min, lod.max))
+
+def get_rotation_matrix(rotation) -> np.ndarray:
+    # same axis order as merge.rotate_world_position: roll, then pitch, then yaw
+    yaw, pitch, roll = np.radians([float(axis) for axis in rotation])
+    Ryaw = np.array([
+        [np.cos(yaw), 0.0, np.sin(yaw)],
+        [0.0, 1.0, 0.0],
+        [-np.sin(yaw), 0.0, np.cos(yaw)]])
+    Rpitch = np.array([
+        [1.0, 0.0, 0.0],
+        [0.0, np.cos(pitch), -np.sin(pitch)],
+        [0.0, np.sin(pitch), np.cos(pitch)]])
+    Rroll = np.array([
+        [np.cos(roll), -np.sin(roll), 0.0],
+        [np.sin(roll), np.cos(roll), 0.0],
+        [0.0, 0.0, 1.0]])
+    return Ryaw @ Rpitch @ Rroll
+
+def get_instance_matrix(position, rotation, base_position, base_rotation) -> np.ndarray:
+    # 3x4 [R|t] taking instance object space into base object space
+    base_inverse = get_rotation_matrix(base_rotation).T
+    matrix = np.empty((3, 4))
+    matrix[:, :3] = base_inverse @ get_rotation_matrix(rotation)
+    matrix[:, 3] = base_inverse @ (np.asarray([*position], dtype=float) - np.asarray([*base_position], dtype=float))
+    return matrix
+
+def transform_vertices(
+        mesh: StaticMesh,
+        matrix: np.ndarray,
+        vertices: np.ndarray = None,
+        out: np.ndarray = None,
+        ) -> np.ndarray:
+    # positions, normals and tangents rotated in one matmul, positions then translated,
+    # vertices default to whole mesh and out to a new array
+    if vertices is None:
+        vertices = mesh.vertices
+    if out is None:
+        out = np.empty_like(vertices)
+    out[:] = vertices
+    position_columns = mesh.get_columns(USAGE_POSITION)
+    columns = position_columns + mesh.get_columns(USAGE_NORMAL, USAGE_TANGENT)
+    if not columns:
+        return out
+    indices = np.concatenate([np.arange(column, column+3) for column in columns])
+    vectors = out[:, indices].reshape(len(out), len(columns), 3)
+    vectors = vectors @ matrix[:, :3].T.astype('<f4')
+    vectors[:, :len(position_columns)] += matrix[:, 3].astype('<f4')
+    out[:, indices] = vectors.reshape(len(out), -1)
+    return out
+
+def get_identity_lod_plan(instances: List[Tuple[StaticMesh, np.ndarray]]) -> List[List[List[Tuple[int, int]]]]:
+    # every instance in every lod with its own lod of same index
+    template = instances[0][0]
+    return [
+        [[(instance, lodId) for instance in range(len(instances))] for lodId in range(len(geom))]
+        for geom in template.geoms]
+
+def merge_instances(
+        instances: List[Tuple[StaticMesh, np.ndarray]],
+        lod_plan: List[List[List[Tuple[int, int]]]] = None,
+        ) -> StaticMesh:
+    # instances share layout (see MergeCache), first one is used as template for headers/nodes
+    # lod_plan is geom -> merged lod -> (instance, source lod) to take
+    template = instances[0][0]
+    if lod_plan is None:
+        lod_plan = get_identity_lod_plan(instances)
+
+    merged = StaticMesh()
+    merged.head = template.head
+    merged.u1 = template.u1
+    merged.vertattribs = list(template.vertattribs)
+    merged.vertformat = template.vertformat
+    merged.vertstride = template.vertstride
+    merged.u2 = template.u2
+
+    # layout pass on material tables only:
+    # (mesh, matrix, source material, merged vstart, merged istart, index offset)
+    copies: List[Tuple[StaticMesh, np.ndarray, Material, int, int, int]] = []
+    vstart, istart = 0, 0
+    for geomId, geom_plan in enumerate(lod_plan):
+        merged_geom: List[Lod] = []
+        for lodId, members in enumerate(geom_plan):
+            # lods past the source ones reuse nodes of the last one
+            template_lod = template.geoms[geomId][min(lodId, len(template.geoms[geomId]) - 1)]
+            lod = Lod()
+            lod.pivot = template_lod.pivot
+            lod.nodes = template_lod.nodes
+            # same material in several instances becomes one drawcall
+            sources = {}
+            for instance, sourceLodId in members:
+                mesh, matrix = instances[instance]
+                for material in mesh.geoms[geomId][sourceLodId].materials:
+                    sources.setdefault(material.key, []).append((mesh, matrix, material))
+            for parts in sources.values():
+                material = None
+                for mesh, matrix, source in parts:
+                    if material is None or material.vnum + source.vnum > MAX_MATERIAL_VERTICES:
+                        material = Material()
+                        material.alphamode, material.fxfile, material.technique, maps = source.key
+                        material.maps = list(maps)
+                        material.u4, material.u5, material.u6 = source.u4, source.u5, source.u6
+                        material.vstart, material.istart = vstart, istart
+                        lod.materials.append(material)
+                    # indices are relative to material vstart
+                    copies.append((mesh, matrix, source, vstart, istart, material.vnum))
+                    material.vnum += source.vnum
+                    material.inum += source.inum
+                    vstart += source.vnum
+                    istart += source.inum
+            merged_geom.append(lod)
+        merged.geoms.append(merged_geom)
+
+    # output allocated once, sources are read through their mapped views slice by slice
+    vertices = np.empty((vstart, template.vertstride // template.vertformat), dtype='<f4')
+    index = np.empty(istart, dtype='<u2')
+    for mesh, matrix, source, vstart, istart, offset in copies:
+        transform_vertices(
+            mesh, matrix,
+            mesh.vertices[source.vstart:source.vstart+source.vnum],
+            vertices[vstart:vstart+source.vnum])
+        np.add(mesh.index[source.istart:source.istart+source.inum], np.uint16(offset),
+               out=index[istart:istart+source.inum])
+    merged.vertices = vertices
+    merged.index = index
+    merged.update_bounds()
+    return merged
@@ -1,79 +1,175 @@
 import os
-import re
-import logging
-from typing import Dict, List
+from typing import Dict, Iterable, List
+
+import numpy as np
+
 from geometry import Geometry
+from bf2config import ObjectBlock, iter_object_blocks
+from bf2writer import format_object
 
 from vec3 import Vec3
 
 
 
 def parse_config_staticobjects(fname: os.PathLike):
-    # windows using CR LF for ending line
-    pattern_create = r'^Object.create (?P<name>.+)\r?\n'
-    pattern_create += r'Object.absolutePosition (?P<bf2position>\S+)\r?\n'
-    pattern_create += r'Object.rotation (?P<bf2rotation>\S+)\r?\n'
-    pattern_create += r'Object.layer (?P<layer>\d+)\r?\n'
-    pattern_create += r'Object.group (?P<group>\d+)\r?\n'
-
-    pattern_float3 = r'(-?\d+\.\d+)/(-?\d+\.\d+)/(-?\d+\.\d+)'
-
-    with open(fname, 'r') as staticobjects:
-        matches = re.findall(
-                            pattern=pattern_create,
-                            string=staticobjects.read(),
-                            flags=re.IGNORECASE | re.MULTILINE)
-    staticobjects: List[Staticobject] = []
-    for match in matches:
-        name, position, rotation, layer, group = match
-        position = re.match(pattern_float3, position)
-        rotation = re.match(pattern_float3, rotation)
-        if not position:
-            logging.warning(match)
-        staticobject = Staticobject(name)
-        staticobject.setPosition(*position.groups())
-        staticobject.setRotation(*rotation.groups())
-        staticobject.group = group
-        staticobjects.append(staticobject)
-    
-    return staticobjects
+    return parse_config_table(fname).staticobjects
+
+def parse_config_table(fname: os.PathLike):
+    return StaticobjectTable.from_blocks(iter_object_blocks(fname))
+
+class StaticobjectTable(object):
+    # columnar store for placed objects, Staticobject rows are views into it
+
+    def __init__(self):
+        # interned template names, name_ids index into these
+        self.names: List[str] = []
+        self.name_geometries: List[Geometry] = []
+        self._name_ids: Dict[str, int] = {}
+        self.name_ids = np.zeros(0, dtype=np.int32)
+        self.positions = np.zeros((0, 3), dtype=np.float64)
+        self.rotations = np.zeros((0, 3), dtype=np.float64)
+        self.groups = np.zeros(0, dtype=np.int64)
+        self.staticobjects: List[Staticobject] = []
+
+    @classmethod
+    def from_blocks(cls, blocks: Iterable[ObjectBlock]) -> 'StaticobjectTable':
+        table = cls()
+        name_ids: List[int] = []
+        positions: List[tuple] = []
+        rotations: List[tuple] = []
+        groups: List[int] = []
+        for block in blocks:
+            name_ids.append(table.intern(block.name))
+            positions.append(block.position)
+            rotations.append(block.rotation)
+            groups.append(block.group)
+        table.name_ids = np.array(name_ids, dtype=np.int32)
+        table.positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+        table.rotations = np.array(rotations, dtype=np.float64).reshape(-1, 3)
+        table.groups = np.array(groups, dtype=np.int64)
+        table.staticobjects = [Staticobject._view(table, row) for row in range(len(name_ids))]
+        return table
+
+    def __len__(self):
+        return len(self.name_ids)
+
+    def __getitem__(self, row: int) -> 'Staticobject':
+        return self.staticobjects[row]
+
+    def __iter__(self):
+        return iter(self.staticobjects)
+
+    def intern(self, name: str) -> int:
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+            self.name_geometries.append(None)
+        return name_id
+
+    def get_groups(self, rows: np.ndarray = None) -> List[List['Staticobject']]:
+        # stable argsort keeps file order inside a group
+        if rows is None:
+            rows = np.arange(len(self))
+        order = rows[np.argsort(self.groups[rows], kind='stable')]
+        boundaries = np.flatnonzero(np.diff(self.groups[order])) + 1
+        return [[self.staticobjects[row] for row in group] for group in np.split(order, boundaries) if len(group)]
 
 class Staticobject(object):
+    __slots__ = ('_table', '_row', '_name', '_position', '_rotation', '_group', '_geometry', '_template')
+
     def __init__(self, name: str):
-        self.name = name
-        self.position = Vec3(0.0, 0.0, 0.0)
-        self.rotation = Vec3(0.0, 0.0, 0.0)
-        self.group = 0
+        self._table: StaticobjectTable = None
+        self._row = -1
+        self._name = name
+        self._position = Vec3(0.0, 0.0, 0.0)
+        self._rotation = Vec3(0.0, 0.0, 0.0)
+        self._group = 0
         self._geometry: Geometry = None
         self._template = None
+
+    @classmethod
+    def _view(cls, table: StaticobjectTable, row: int) -> 'Staticobject':
+        staticobject = cls.__new__(cls)
+        staticobject._table = table
+        staticobject._row = row
+        staticobject._geometry = None
+        staticobject._template = None
+        return staticobject
+
+    @property
+    def table(self) -> StaticobjectTable:
+        return self._table
+
+    @property
+    def row(self):
+        return self._row
+
+    @property
+    def name(self) -> str:
+        if self._table is not None:
+            return self._table.names[self._table.name_ids[self._row]]
+        return self._name
+
+    @name.setter
+    def name(self, name: str):
+        if self._table is not None:
+            self._table.name_ids[self._row] = self._table.intern(name)
+        else:
+            self._name = name
+
+    @property
+    def position(self) -> Vec3:
+        if self._table is not None:
+            return Vec3(*self._table.positions[self._row])
+        return self._position
+
+    @property
+    def rotation(self) -> Vec3:
+        if self._table is not None:
+            return Vec3(*self._table.rotations[self._row])
+        return self._rotation
+
+    @property
+    def group(self) -> int:
+        if self._table is not None:
+            return int(self._table.groups[self._row])
+        return self._group
+
+    @group.setter
+    def group(self, group: int):
+        if self._table is not None:
+            self._table.groups[self._row] = group
+        else:
+            self._group = group
     
     def setPosition(self, x, y, z):
-        self.position = Vec3(x, y, z)
+        if self._table is not None:
+            self._table.positions[self._row] = (float(x), float(y), float(z))
+        else:
+            self._position = Vec3(x, y, z)
     
     def setRotation(self, yaw, pitch, roll):
         # bf2 world rotated?
         #self.rotation = Vec3(0 - float(yaw), pitch, roll)
-        self.rotation = Vec3(yaw, pitch, roll)
+        if self._table is not None:
+            self._table.rotations[self._row] = (float(yaw), float(pitch), float(roll))
+        else:
+            self._rotation = Vec3(yaw, pitch, roll)
     
+    def __reduce__(self):
+        # rows pickle detached from their table, workers get the object and not the whole level
+        return (_detached_staticobject, (
+            self.name, [*self.position], [*self.rotation], self.group, self.geometry, self._template))
+
     def __str__(self):
         return f'{self.name} ({self.position})'
     
     def __repr__(self):
         return f'{self.name}'
     
-    def _bf2float3str(self, float3: List[float]):
-        return f'{float3[0]}/{float3[1]}/{float3[2]}'
-    
     def generateCreateCommands(self):
-        command = f'''
-rem *** {self.name} ***
-Object.create {self.name}
-Object.absolutePosition {self._bf2float3str([*self.position])}
-Object.rotation {self._bf2float3str([*self.rotation])}
-Object.layer 1
-Object.group {self.group}
-'''
-        return command
+        return format_object(self.name, [*self.position], [*self.rotation], self.group)
     
     @property
     def template(self):
@@ -81,24 +177,18 @@ Object.group {self.group}
     
     @property
     def geometry(self):
+        if self._geometry is None and self._table is not None:
+            return self._table.name_geometries[self._table.name_ids[self._row]]
         return self._geometry
     
-    # NOTE: quik hax, developer proper loading from template
-    def _setGeometry(self,
-        configpath: os.PathLike,
-        geometries: Dict[str, Geometry],
-        ):
-        with open(configpath) as config:
-            match = re.search(
-                r'ObjectTemplate\.geometry (?P<geometry>\S+)',
-                config.read(),
-                re.IGNORECASE | re.MULTILINE)
-            if match:
-                geometryname = match.group('geometry')
-                logging.info(f'Found geometry {geometryname} for {self.name}')
-                self._geometry = geometries[geometryname]
-            else:
-                #errmsg = f'could not find mesh path for {self._template.name}'
-                errmsg = f'could not find mesh path for {self.name}'
-                logging.error(errmsg)
-                raise FileNotFoundError(errmsg)
\ No newline at end of file
+    def _setGeometry(self, geometry: Geometry):
+        self._geometry = geometry
+
+def _detached_staticobject(name: str, position: list, rotation: list, group: int, geometry: Geometry, template) -> Staticobject:
+    staticobject = Staticobject(name)
+    staticobject.setPosition(*position)
+    staticobject.setRotation(*rotation)
+    staticobject.group = group
+    staticobject._geometry = geometry
+    staticobject._template = template
+    return staticobject
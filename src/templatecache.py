@@ -0,0 +1,79 @@
+import os
+import shutil
+import hashlib
+import logging
+from typing import Callable, Dict, Iterable
+
+import instrument
+from fileops import link_tree, remove_tree
+from manifest import get_template_hash
+from mergecache import MergeCache, get_file_hash
+from mod import get_cache_dir
+
+# bump when generated templates change for the same source
+TEMPLATE_CACHE_VERSION = 2
+
+class TemplateCache(object):
+
+    def __init__(self, cachedir: os.PathLike = None, mergecache: MergeCache = None):
+        # generated templates are stored as <name>-<key> folders
+        self.cachedir = cachedir
+        # source files hashed by content, cached by mtime and size when shared with merge cache
+        self.file_hash = mergecache.get_file_hash if mergecache else get_file_hash
+        self._template_hashes: Dict[str, str] = {}
+
+    def get_key(self, src: os.PathLike, name: str, rules: Iterable) -> str:
+        if src not in self._template_hashes:
+            self._template_hashes[src] = get_template_hash(src, self.file_hash)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((TEMPLATE_CACHE_VERSION, self._template_hashes[src], name, list(rules))).encode())
+        return digest.hexdigest()
+
+    def _prune(self, name: str, keep: str):
+        # older generations of same template, levels keep their own links
+        # .tmp folders belong to runs still generating, never pruned
+        for entry in os.listdir(self.cachedir):
+            if entry != keep and not entry.endswith('.tmp') and entry.rpartition('-')[0] == name:
+                logging.info('removing outdated %s from template cache', entry)
+                shutil.rmtree(os.path.join(self.cachedir, entry), ignore_errors=True)
+
+    def materialize(
+            self,
+            src: os.PathLike,
+            name: str,
+            rules: Iterable,
+            dst: os.PathLike,
+            generate: Callable[[os.PathLike], None],
+            ):
+        # generate(path) writes template into path, done once per source content
+        if not self.cachedir:
+            generate(dst)
+            return
+        entry = f'{name}-{self.get_key(src, name, rules)}'
+        cached = os.path.join(self.cachedir, entry)
+        if os.path.isdir(cached):
+            instrument.count('template_cache_hits')
+            logging.info('reusing %s from template cache', name)
+        else:
+            instrument.count('template_cache_misses')
+            # per process, concurrent runs never share a work folder
+            tmp = f'{cached}.{os.getpid()}.tmp'
+            remove_tree(tmp)
+            generate(tmp)
+            try:
+                os.rename(tmp, cached)
+            except OSError:
+                # generated meanwhile by another run
+                shutil.rmtree(tmp, ignore_errors=True)
+                if not os.path.isdir(cached):
+                    raise
+            self._prune(name, entry)
+        remove_tree(dst)
+        link_tree(cached, dst)
+
+def get_template_cache(modroot: os.PathLike, cache=True, mergecache: MergeCache = None) -> TemplateCache:
+    if not cache:
+        return TemplateCache(mergecache=mergecache)
+    cachedir = os.path.join(get_cache_dir(modroot), 'templates')
+    os.makedirs(cachedir, exist_ok=True)
+    return TemplateCache(cachedir, mergecache)
@@ -0,0 +1,67 @@
+import os
+import re
+import logging
+from typing import Dict, Iterable, List, NamedTuple
+
+import instrument
+
+# rule actions
+REM = 'rem'
+# undo template rename on the line, e.g. collision mesh of _col objects
+KEEP_NAME = 'keep_name'
+
+class TemplateRule(NamedTuple):
+    # case insensitive command prefix at line start
+    prefix: str
+    action: str
+
+class TemplateRewriter(object):
+
+    def __init__(self, rules: Iterable[TemplateRule]):
+        self.rules: List[TemplateRule] = list(rules)
+        # first rule wins for same prefix
+        self.actions: Dict[str, str] = {}
+        for rule in self.rules:
+            self.actions.setdefault(rule.prefix.lower(), rule.action)
+        # longest prefixes first so alternation picks most specific one
+        prefixes = sorted(self.actions, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(prefix) for prefix in prefixes), re.IGNORECASE) if prefixes else None
+
+    def rewrite_line(self, line: str, name_old: str, name_new: str) -> str:
+        line = line.replace(name_old, name_new)
+        match = self.pattern.match(line) if self.pattern else None
+        if match is None:
+            return line
+        action = self.actions[match.group(0).lower()]
+        if action == REM:
+            return 'rem ' + line
+        if action == KEEP_NAME:
+            return line.replace(name_new, name_old)
+        return line
+
+    def rewrite(self, src: os.PathLike, dst: os.PathLike, name_old: str, name_new: str):
+        logging.info("generating %s with replaced '%s'->'%s' from %s", dst, name_old, name_new, src)
+        with open(src, 'r') as oldconfig, open(dst, 'w') as newconfig:
+            newconfig.writelines(
+                self.rewrite_line(line.rstrip('\n'), name_old, name_new) + '\n' for line in oldconfig)
+            instrument.count('config_bytes_written', newconfig.tell())
+        instrument.count('configs_written')
+
+# merged visible objects, collision stays on _col objects
+REWRITE_REMOVE_COLLISION = TemplateRewriter([
+    TemplateRule('CollisionManager', REM),
+    TemplateRule('ObjectTemplate.collisionMesh', REM),
+    TemplateRule('ObjectTemplate.setCollisionMesh', REM),
+    TemplateRule('ObjectTemplate.mapMaterial', REM),
+    TemplateRule('ObjectTemplate.hasCollisionPhysics', REM),
+    TemplateRule('ObjectTemplate.physicsType', REM),
+    ])
+
+# _col objects, collision mesh is still loaded from source template
+REWRITE_REMOVE_VISIBLE = TemplateRewriter([
+    TemplateRule('GeometryTemplate', REM),
+    TemplateRule('ObjectTemplate.geometry', REM),
+    TemplateRule('ObjectTemplate.cullRadiusScale', REM),
+    TemplateRule('ObjectTemplate.collisionMesh', KEEP_NAME),
+    TemplateRule('ObjectTemplate.setCollisionMesh', KEEP_NAME),
+    ])
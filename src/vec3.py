@@ -1,4 +1,6 @@
 class Vec3(object):
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, x, y, z):
         self.x = float(x)
         self.y = float(y)
@@ -14,11 +16,12 @@ class Vec3(object):
         return [self.x, self.y, self.z]
     
     def __iter__(self):
-        for value in [self.x, self.y, self.z]:
-            yield value
+        yield self.x
+        yield self.y
+        yield self.z
     
     def __add__(self, v):
-        if isinstance(self, Vec3):
+        if isinstance(v, Vec3):
             return Vec3(self.x + v.x, self.y + v.y, self.z + v.z)
         else:
             return Vec3(self.x + v, self.y + v, self.z + v)